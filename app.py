@@ -10,99 +10,2191 @@
 cdn = 'http://www.wdcdn.net/'
 uri = 'rss/presentation/library/client/iowa/id/128b053b916ea1f7f20233e8a26bc45d'
 
+# Other client libraries' feeds are served at /feed/<client>/<id>. The refresher
+# keeps the max_feeds most recently served ones warm, until left idle for
+# feed_idle_timeout seconds. All feeds share the asset cache, the fetch pools
+# and the cap on concurrent CDN requests.
+feed_uri_format = 'rss/presentation/library/client/%s/id/%s'
+max_feeds = 100
+feed_idle_timeout = 24 * 60 * 60
+
+# Fetch worker pool. 'thread' suits the I/O-bound fetches; 'process' sidesteps
+# the GIL for PyAV header decoding at the cost of a fork per worker.
+fetch_mode = 'thread'
+fetch_workers = 15
+
+# Feed pipeline engine. 'pool' fetches and parses each asset in one fetch pool
+# task; 'pipeline' fetches headers on many lightweight I/O threads, and hands
+# the CPU-bound parsing to the fetch pool.
+fetch_engine = 'pool'
+io_workers = 50
+
+# Kept-alive connections to the CDN, and the cap on concurrent CDN requests.
+cdn_connections = 20
+
+# CDN requests time out after cdn_timeout (connect, read) seconds, and failed
+# ones are retried up to cdn_retries times with exponential backoff. No asset
+# probe runs past asset_deadline seconds, and no rebuild waits past
+# rebuild_budget seconds for its slowest assets. Entries left without metadata
+# render it as unknown, and are retried in the background after
+# metadata_retry_delay seconds, doubling while they keep failing.
+cdn_timeout = (3.05, 10)
+cdn_retries = 2
+cdn_retry_backoff = 0.5
+asset_deadline = 20
+rebuild_budget = 30
+metadata_retry_delay = 60
+
+# How often the feed snapshot is revalidated, plus how long past that a stale
+# copy may still be served while a single background rebuild refreshes it.
+# Revalidation is a conditional GET that only reparses changed entries, so it
+# can run often.
+cache_timeout = 15 * 60
+cache_stale_timeout = 24 * 60 * 60
+
+# Per-asset header metadata cache. Asset files rarely change, so probe results
+# outlive the feed snapshot and are only redone for new or modified files.
+asset_cache_timeout = 30 * 24 * 60 * 60
+asset_cache_threshold = 5000
+
+# Video headers are probed through HTTP Range requests. Reads start with a small
+# window that doubles on each further sequential read, up to the maximum.
+probe_initial_bytes = 16 * 1024
+probe_max_bytes = 1024 * 1024
+
+# Thumbnails are fetched from the CDN once, resized to cover the display box,
+# re-encoded and served locally from thumbnail_dir. Past thumbnail_threshold
+# files, the least recently served are evicted.
+thumbnail_dir = '/tmp/wiredrive_devtest/thumbnails'
+thumbnail_width = 180
+thumbnail_height = 100
+thumbnail_quality = 80
+thumbnail_threshold = 5000
+
+# Feed pages list page_size entries, ordered by ?sort= and filtered by
+# ?client= and ?keyword=. Sort keys map to (key function, descending) pairs.
+page_size = 50
+sort_keys = {
+  'title': (lambda k: k.title, False),
+  'date': (lambda k: k.published, True),
+  'duration': (lambda k: k.duration, False),
+  'size': (lambda k: k.size, False)
+}
+
+# Cache backend: 'simple' keeps entries in per-process memory, 'filesystem'
+# shares them between every worker on the host and 'redis' between hosts.
+# Entries are pickled, expire after their timeout and are pruned past the
+# threshold. Rendered pages are kept apart from feed snapshots, so they can't
+# crowd them out.
+cache_backend = 'filesystem'
+cache_dir = '/tmp/wiredrive_devtest'
+cache_threshold = 500
+page_cache_threshold = 2000
+redis_host = 'localhost'
+redis_port = 6379
+
+# The last good snapshot of each feed, and the asset metadata behind it, are
+# also saved to snapshot_dir, so a restarted or freshly deployed app serves them
+# straight away while it refreshes. /var/tmp survives reboots.
+snapshot_dir = '/var/tmp/wiredrive_devtest/snapshots'
+
+# How long one worker may hold the feed rebuild lock before others give up
+# waiting on it and rebuild themselves.
+rebuild_lock_timeout = 5 * 60
+
+# The filesystem backend spreads its locks over this many lock files, so any
+# number of feeds share a fixed set of them.
+lock_slots = 64
+
+# Metrics are also logged to stderr as key=value lines, through their own
+# 'wiredrive.metrics' logger. At 'INFO' that is one line per feed rebuild;
+# 'DEBUG' adds every update, e.g. each cache lookup and range fetch.
+metrics_log_level = 'INFO'
+
+# On a cold cache, stream the page shell right away and each entry as its
+# metadata arrives, rather than waiting for the whole feed.
+stream_cold_render = True
+
+# Background refresher. Rebuilds the snapshot every refresh_interval seconds,
+# give or take refresh_jitter, so requests never wait on a rebuild once one
+# snapshot exists. Failed runs are retried after refresh_backoff seconds,
+# doubling up to refresh_backoff_max. Keep the interval, plus jitter, well
+# under cache_timeout.
+refresh_in_background = True
+refresh_interval = 10 * 60
+refresh_jitter = 0.1
+refresh_backoff = 15
+refresh_backoff_max = 10 * 60
+
 ################################################################################
 # Establish runtime propriety.
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from cStringIO import StringIO
-from flask import Flask, render_template
+from flask import Flask, Response, abort, jsonify, render_template, request
+from flask import send_file, stream_with_context
 from humanize import naturalsize
-from multiprocessing import Pool
-from werkzeug.contrib.cache import SimpleCache
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from werkzeug.contrib.cache import FileSystemCache, RedisCache, SimpleCache
+import atexit
 import av
+import calendar
+import fcntl
 import feedparser
+import gzip
+import hashlib
+import json
+import logging
+import mp4atoms
+import os
+import Queue
+import random
+import re
 import requests
+import stat
+import struct
+import tempfile
+import threading
 import time
+import urllib
+import zlib
+
+# Brotli is optional; pages are precompressed with gzip alone without it.
+try:
+  import brotli
+except ImportError:
+  brotli = None
 
 app = Flask(__name__)
-cache = SimpleCache()
 
 ################################################################################
-# Function definitions.
+# Class definitions.
 
-def parse_metadata(entry):
+class Progress(object):
   """
-  Parses and formats metadata from video file headers. Returns a video metadata
-  dictionary.
+  Results of an in-flight call, published as they are produced. Any number of
+  readers can iterate over them while the call runs.
+  """
+  
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.entries = []
+    self.started = False
+    self.done = False
+    self.error = None
+  
+  def start(self):
+    """
+    Mark the call as past the point where it is likely to fail outright, e.g.
+    once its input has been fetched.
+    """
+    
+    with self.condition:
+      self.started = True
+      self.condition.notify_all()
+  
+  def add(self, entries):
+    with self.condition:
+      self.entries.extend(entries)
+      self.condition.notify_all()
+  
+  def finish(self, error=None):
+    with self.condition:
+      self.done = True
+      self.error = error
+      self.condition.notify_all()
+  
+  def wait_started(self):
+    """
+    Block until the call starts, publishes results or finishes. Returns the
+    error it failed with, if it already has.
+    """
+    
+    with self.condition:
+      while not self.started and not self.entries and not self.done:
+        self.condition.wait()
+      
+      return self.error
+  
+  def __iter__(self):
+    index = 0
+    
+    while True:
+      with self.condition:
+        while index == len(self.entries) and not self.done:
+          self.condition.wait()
+        
+        entries = self.entries[index:]
+      
+      if not entries:
+        return
+      
+      for entry in entries:
+        yield entry
+      
+      index += len(entries)
+
+class SingleFlight(object):
+  """
+  Coalesces concurrent calls sharing a key, so only one runs at a time and every
+  other caller waits on, and shares, its result. Each call is handed a Progress
+  to publish partial results to.
+  """
+  
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+  
+  def join(self, key):
+    with self.lock:
+      call = self.calls.get(key)
+      
+      if call is not None:
+        return call, False
+      
+      call = self.calls[key] = {'done': threading.Event(),
+                                'progress': Progress()}
+    
+    return call, True
+  
+  def run(self, key, call, function):
+    try:
+      call['result'] = function(call['progress'])
+    except Exception as error:
+      call['error'] = error
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      
+      call['progress'].finish(call.get('error'))
+      call['done'].set()
+    
+    return call['result']
+  
+  def do(self, key, function):
+    call, leader = self.join(key)
+    
+    if leader:
+      return self.run(key, call, function)
+    
+    # Followers block until the leader publishes a result or an error.
+    call['done'].wait()
+    
+    if 'error' in call:
+      raise call['error']
+    
+    return call['result']
+  
+  def run_logged(self, key, call, function):
+    # Background calls have no caller to raise to; their error is still handed
+    # to followers through the call and its Progress.
+    try:
+      self.run(key, call, function)
+    except Exception:
+      app.logger.exception('Background call for %s failed.', key)
+  
+  def spawn(self, key, function):
+    """
+    Run function in a background thread unless a call for key is in flight.
+    Returns the Progress of whichever call is running.
+    """
+    
+    call, leader = self.join(key)
+    
+    if leader:
+      thread = threading.Thread(target=self.run_logged,
+                                args=(key, call, function))
+      thread.daemon = True
+      thread.start()
+    
+    return call['progress']
+
+class Refresher(object):
+  """
+  Daemon thread calling function on an interval, with jitter between runs and
+  exponential backoff after failures. The outcome of the last run is kept in
+  status.
+  """
+  
+  def __init__(self, function, interval, jitter, backoff, backoff_max):
+    self.function = function
+    self.interval = interval
+    self.jitter = jitter
+    self.backoff = backoff
+    self.backoff_max = backoff_max
+    self.status = {
+      'state': 'idle',
+      'failures': 0,
+      'last_started': None,
+      'last_duration': None,
+      'last_success': None,
+      'last_error': None,
+      'next_run': None
+    }
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+  
+  def start(self):
+    self.thread.start()
+  
+  def delay(self):
+    if self.status['failures']:
+      return min(self.backoff * 2 ** (self.status['failures'] - 1),
+                 self.backoff_max)
+    
+    return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+  
+  def run(self):
+    while True:
+      started = time.time()
+      self.status.update(state='running', last_started=started, next_run=None)
+      
+      try:
+        self.function()
+      except Exception as error:
+        app.logger.exception('Background refresh failed.')
+        self.status['failures'] += 1
+        self.status.update(state='failed', last_error=repr(error))
+      else:
+        self.status.update(state='ok', failures=0, last_success=time.time())
+      
+      delay = self.delay()
+      self.status.update(last_duration=time.time() - started,
+                         next_run=time.time() + delay)
+      
+      time.sleep(delay)
+
+class RangeFile(object):
+  """
+  Read-only, seekable file over HTTP Range requests. Only the byte windows a
+  reader actually touches are fetched, so a demuxer can skip straight from the
+  file header to a moov atom at the tail without downloading the middle.
+  """
+  
+  # FFmpeg's AVSEEK_SIZE pseudo-whence, asking for the total size.
+  seek_size = 0x10000
+  
+  def __init__(self, url, initial=probe_initial_bytes, maximum=probe_max_bytes,
+               deadline=asset_deadline):
+    self.url = url
+    self.initial = initial
+    self.maximum = maximum
+    self.deadline = time.time() + deadline
+    self.window = initial
+    self.position = 0
+    self.segments = []
+    self.last_end = None
+    self.size = None
+    self.headers = {}
+    self.fetched = 0
+    self.requests = 0
+    self.seconds = 0
+    
+    # The first window yields the total size and the asset's validators.
+    self.segment(0)
+  
+  def fetch(self, start, length):
+    end = start + length - 1
+    
+    if self.size is not None:
+      end = min(end, self.size - 1)
+    
+    started = time.time()
+    
+    with cdn_slots:
+      remaining = self.deadline - time.time()
+      
+      if remaining <= 0:
+        raise IOError('Deadline exceeded fetching %s.' % self.url)
+      
+      response = session.get(self.url, stream=True,
+                             headers={'Range': 'bytes=%d-%d' % (start, end)},
+                             timeout=(cdn_timeout[0],
+                                      min(cdn_timeout[1], remaining)))
+      response.raise_for_status()
+      
+      if response.status_code == 206:
+        data = response.content
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        
+        if total.isdigit():
+          self.size = int(total)
+      else:
+        # Range was ignored; read through to the window in bounded chunks,
+        # against the deadline, and drop the rest.
+        try:
+          skipped = 0
+          
+          while skipped < start:
+            if time.time() > self.deadline:
+              raise IOError('Deadline exceeded fetching %s.' % self.url)
+            
+            chunk = response.raw.read(min(start - skipped, 64 * 1024))
+            
+            if not chunk:
+              break
+            
+            skipped += len(chunk)
+          
+          self.fetched += skipped
+          data = response.raw.read(end - start + 1)
+        finally:
+          response.close()
+        
+        if response.headers.get('Content-Length', '').isdigit():
+          self.size = int(response.headers['Content-Length'])
+    
+    if not self.headers:
+      self.headers = response.headers
+    
+    self.fetched += len(data)
+    self.requests += 1
+    self.seconds += time.time() - started
+    
+    metrics.observe('stage_seconds', {'stage': 'range_fetch'},
+                    time.time() - started, url=self.url, bytes=len(data))
+    metrics.increment('cdn_bytes_total', {'kind': 'asset'}, len(data))
+    
+    return data
+  
+  def segment(self, position):
+    for start, data in self.segments:
+      if start <= position < start + len(data):
+        return start, data
+    
+    # Grow the window while the reader keeps going forward, and start small
+    # again whenever it jumps elsewhere.
+    if position == self.last_end:
+      self.window = min(self.window * 2, self.maximum)
+    else:
+      self.window = self.initial
+    
+    data = self.fetch(position, self.window)
+    
+    self.segments.append((position, data))
+    self.last_end = position + len(data)
+    
+    return position, data
+  
+  def read(self, size=-1):
+    end = self.size if self.size is not None else float('inf')
+    
+    if size is not None and size >= 0:
+      end = min(end, self.position + size)
+    
+    chunks = []
+    
+    while self.position < end:
+      start, data = self.segment(self.position)
+      chunk = data[self.position - start:end - start]
+      
+      if not chunk:
+        break
+      
+      chunks.append(chunk)
+      self.position += len(chunk)
+    
+    return ''.join(chunks)
+  
+  def seek(self, offset, whence=0):
+    if whence == self.seek_size:
+      return self.size if self.size is not None else -1
+    elif whence == 1:
+      offset += self.position
+    elif whence == 2:
+      if self.size is None:
+        return -1
+      
+      offset += self.size
+    
+    self.position = max(offset, 0)
+    
+    return self.position
+  
+  def tell(self):
+    return self.position
+
+class VideoEntry(object):
+  """
+  One video of a feed snapshot, holding only the fields index.html displays.
+  Duration, bitrate, size and publish time are kept raw, and formatted at render
+  time. Pickles as a flat tuple of field values.
+  """
+  
+  __slots__ = ('id', 'title', 'link', 'url', 'width', 'height', 'filename',
+               'client', 'credits', 'keywords', 'published', 'duration',
+               'bitrate', 'codec', 'size', 'thumbnail', 'thumbnail_digest')
+  
+  def __init__(self, **fields):
+    for name in self.__slots__:
+      setattr(self, name, fields.pop(name, None))
+    
+    if fields:
+      raise TypeError('Unexpected VideoEntry fields: %s.' % ', '.join(fields))
+  
+  def __getstate__(self):
+    return tuple(getattr(self, name) for name in self.__slots__)
+  
+  def __setstate__(self, state):
+    for name, value in zip(self.__slots__, state):
+      setattr(self, name, value)
+  
+  @classmethod
+  def from_state(cls, state):
+    """
+    Rebuild an entry from its field values after a round trip through JSON,
+    which turns tuples into lists. Returns a VideoEntry.
+    """
+    
+    entry = cls.__new__(cls)
+    entry.__setstate__(state)
+    entry.credits = tuple(tuple(c) for c in entry.credits or ())
+    entry.keywords = tuple(entry.keywords or ())
+    
+    return entry
+
+class Metrics(object):
+  """
+  Counters and histograms for the feed pipeline, exported in Prometheus text
+  format. Every update is also logged at DEBUG as a structured key=value line,
+  with any extra fields too varied to keep as labels, e.g. URLs; events that
+  sum up a whole operation are logged at INFO. Values are per process;
+  process-mode fetch pool workers keep their own.
   """
   
-  # Stream in first 164 KB of each file to parse metadata.
-  data = requests.get(entry['media_content'][0]['url'], stream=True)
-  asset = StringIO(data.raw.read(167936))
+  # Histogram bucket upper bounds, picked by metric name suffix.
+  buckets = {
+    'seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'bytes': (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+  }
+  
+  def __init__(self, prefix, descriptions, logger):
+    self.prefix = prefix
+    self.descriptions = descriptions
+    self.logger = logger
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+  
+  def increment(self, name, labels, value=1, **fields):
+    key = (name, tuple(sorted(labels.items())))
+    
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+    
+    self.log(logging.DEBUG, [('metric', name)] + sorted(labels.items()) +
+             [('value', value)] + sorted(fields.items()))
+  
+  def observe(self, name, labels, value, **fields):
+    key = (name, tuple(sorted(labels.items())))
+    bounds = self.buckets[name.rpartition('_')[2]]
+    
+    with self.lock:
+      histogram = self.histograms.setdefault(
+        key, {'buckets': [0] * len(bounds), 'count': 0, 'sum': 0})
+      
+      for index, bound in enumerate(bounds):
+        if value <= bound:
+          histogram['buckets'][index] += 1
+      
+      histogram['count'] += 1
+      histogram['sum'] += value
+    
+    self.log(logging.DEBUG, [('metric', name)] + sorted(labels.items()) +
+             [('value', value)] + sorted(fields.items()))
+  
+  @contextmanager
+  def timer(self, stage, **fields):
+    started = time.time()
+    
+    try:
+      yield
+    finally:
+      self.observe('stage_seconds', {'stage': stage}, time.time() - started,
+                   **fields)
+  
+  def event(self, name, **fields):
+    """
+    Log one INFO line summing up an operation, e.g. a feed rebuild.
+    """
+    
+    self.log(logging.INFO, [('event', name)] + sorted(fields.items()))
+  
+  def log(self, level, pairs):
+    # Skip formatting lines that would only be dropped.
+    if self.logger.isEnabledFor(level):
+      self.logger.log(level, ' '.join('%s=%s' % (k, json.dumps(v))
+                                      for k, v in pairs))
+  
+  def export(self):
+    """
+    Render every metric in Prometheus text exposition format. Returns a string.
+    """
+    
+    lines = []
+    
+    def header(name, kind):
+      lines.append('# HELP %s_%s %s' % (self.prefix, name,
+                                        self.descriptions.get(name, name)))
+      lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+    
+    def sample(name, labels, value):
+      pairs = ','.join('%s=%s' % (k, json.dumps(str(v))) for k, v in labels)
+      lines.append('%s_%s%s %s' % (self.prefix, name,
+                                   '{%s}' % pairs if pairs else '', value))
+    
+    with self.lock:
+      counters = sorted(self.counters.items())
+      histograms = sorted((k, dict(v, buckets=list(v['buckets'])))
+                          for k, v in self.histograms.items())
+    
+    for index, ((name, labels), value) in enumerate(counters):
+      if not index or counters[index - 1][0][0] != name:
+        header(name, 'counter')
+      
+      sample(name, labels, value)
+    
+    for index, ((name, labels), histogram) in enumerate(histograms):
+      if not index or histograms[index - 1][0][0] != name:
+        header(name, 'histogram')
+      
+      bounds = self.buckets[name.rpartition('_')[2]]
+      
+      for count, bound in zip(histogram['buckets'], bounds):
+        sample(name + '_bucket', labels + (('le', bound),), count)
+      
+      sample(name + '_bucket', labels + (('le', '+Inf'),), histogram['count'])
+      sample(name + '_sum', labels, repr(histogram['sum']))
+      sample(name + '_count', labels, histogram['count'])
+    
+    return '\n'.join(lines) + '\n'
+
+################################################################################
+# Function definitions.
+
+def decode_headers(asset):
+  """
+  Decode video metadata with PyAV, for containers mp4atoms can't read. Returns
+  the same dictionary of encoder, duration and bit rate as mp4atoms.probe.
+  """
   
-  # Parse video metadata with PyAV (ffmpeg wrapper).
   container = av.open(asset)
   stream = next(s for s in container.streams if s.type == 'video')
   
+  return {
+    'encoder': stream.metadata['encoder'],
+    'duration': float(stream.duration * stream.time_base),
+    'bit_rate': stream.bit_rate
+  }
+
+def probe_asset(url, asset=None):
+  """
+  Fetch and decode a video file's headers, reusing any bytes already read into
+  asset. Returns a dictionary of codec, duration and bitrate, the validators the
+  CDN served it with and the number of bytes fetched. Duration is in seconds and
+  bitrate in bits per second.
+  """
+  
+  # Read only the header bytes the parser asks for.
+  if asset is None:
+    asset = RangeFile(url)
+  
+  # Parse QuickTime/MP4 headers natively, and anything else, or anything it
+  # finds corrupt, with PyAV (ffmpeg wrapper). Decode time leaves out the range
+  # fetches parsing triggers.
+  started, fetching = time.time(), asset.seconds
+  
+  try:
+    video = mp4atoms.probe(asset)
+    decoder = 'mp4atoms'
+  except (mp4atoms.UnsupportedFormat, struct.error, ValueError):
+    asset.seek(0)
+    video = decode_headers(asset)
+    decoder = 'av'
+  
+  metrics.observe('stage_seconds', {'stage': 'decode_' + decoder},
+                  time.time() - started - (asset.seconds - fetching), url=url)
+  metrics.observe('asset_fetched_bytes', {}, asset.fetched, url=url,
+                  size=asset.size, requests=asset.requests)
+  
   # Add duration, video codec and bitrate values to video metadata dictionaries.
   # @NOTE: Requirement 2.
-  minutes, seconds = divmod(stream.duration / 600, 60)
+  return {
+    'codec': video['encoder'],
+    'duration': video['duration'],
+    'bitrate': int(video['bit_rate']),
+    'etag': asset.headers.get('ETag'),
+    'last_modified': asset.headers.get('Last-Modified'),
+    'probe_bytes': asset.fetched
+  }
+
+def asset_key(url, filesize):
+  return 'probe:%s:%s' % (url, filesize or '')
+
+def cached_asset(url, filesize):
+  """
+  Return cached header metadata for an asset, or None when it is new or has
+  changed. Assets are keyed on URL plus the feed's advertised file size; when
+  the feed omits the size, the cached ETag/Last-Modified are revalidated with a
+  HEAD request instead.
+  """
+  
+  metadata = asset_cache.get(asset_key(url, filesize))
+  
+  if metadata is not None and not filesize:
+    with metrics.timer('asset_head', url=url), cdn_slots:
+      headers = session.head(url, timeout=cdn_timeout).headers
+    
+    if (headers.get('ETag'), headers.get('Last-Modified')) != \
+       (metadata['etag'], metadata['last_modified']):
+      metadata = None
+  
+  metrics.increment('cache_requests_total',
+                    {'cache': 'asset', 'result': 'miss' if metadata is None
+                                                 else 'hit'}, url=url)
+  
+  return metadata
+
+def store_asset(url, filesize, asset=None):
+  """
+  Probe an asset and cache its header metadata. Concurrent probes of the same
+  asset, e.g. from two feeds it appears in, share one fetch. Returns the
+  metadata.
+  """
+  
+  def probe(progress):
+    metadata = probe_asset(url, asset)
+    asset_cache.set(asset_key(url, filesize), metadata)
+    
+    return metadata
+  
+  return asset_flight.do(asset_key(url, filesize), probe)
+
+def lookup_asset(url, filesize):
+  """
+  Return header metadata for an asset, probing it only when it is new or has
+  changed.
+  """
+  
+  metadata = cached_asset(url, filesize)
+  
+  if metadata is None:
+    metadata = store_asset(url, filesize)
+  
+  return metadata
+
+def prefetch_asset(entry):
+  """
+  I/O stage of the pipeline engine. On an asset cache miss, reads the header
+  bytes the parser will need, and on a thumbnail cache miss the thumbnail
+  itself, so parsing makes no further round trips. Returns an (entry, metadata,
+  asset, digest, thumbnail) tuple: either the asset's metadata or its header
+  bytes, and either the stored thumbnail's digest or its content. Either pair
+  is left empty if its fetch failed.
+  """
+  
+  media = entry['media_content'][0]
+  metadata = asset = None
+  
+  try:
+    metadata = cached_asset(media['url'], media.get('filesize'))
+    
+    if metadata is None:
+      asset = RangeFile(media['url'])
+      
+      try:
+        mp4atoms.read_moov(asset)
+      except (mp4atoms.UnsupportedFormat, struct.error, ValueError):
+        pass
+  except Exception:
+    app.logger.warning('Failed to fetch %s.', media['url'], exc_info=True)
+    metrics.increment('asset_failures_total', {'stage': 'fetch'},
+                      url=media['url'])
+    asset = None
+  
+  source = thumbnail_source(entry)
+  digest = cached_thumbnail(source)
+  thumbnail = None
+  
+  if digest is None:
+    try:
+      thumbnail = fetch_thumbnail(source)
+    except Exception:
+      app.logger.warning('Failed to proxy thumbnail %s.', source,
+                         exc_info=True)
+  
+  return entry, metadata, asset, digest, thumbnail
+
+def finish_entry(prefetched):
+  """
+  CPU stage of the pipeline engine. Parses prefetched header bytes, and
+  resizes and stores a prefetched thumbnail, where needed. Returns a
+  VideoEntry, with metadata unknown if the asset failed.
+  """
+  
+  entry, metadata, asset, digest, thumbnail = prefetched
+  media = entry['media_content'][0]
   
-  entry['codec'] = stream.metadata['encoder']
-  entry['duration'] = '%sm %ss' % (minutes, seconds)
-  entry['bitrate'] = '{0:,} kb/s'.format(int(stream.bit_rate / 1024))
+  if metadata is None and asset is not None:
+    try:
+      metadata = store_asset(media['url'], media.get('filesize'), asset)
+    except Exception:
+      app.logger.warning('Failed to probe %s.', media['url'], exc_info=True)
+      metrics.increment('asset_failures_total', {'stage': 'probe'},
+                        url=media['url'])
+  
+  if thumbnail is not None:
+    digest = proxy_thumbnail(thumbnail_source(entry), thumbnail)
+  
+  return format_entry(entry, metadata, digest)
+
+def parse_metadata(entry):
+  """
+  Parses and formats metadata from video file headers. Returns a VideoEntry,
+  with metadata unknown if the asset failed.
+  """
+  
+  media = entry['media_content'][0]
+  
+  try:
+    metadata = lookup_asset(media['url'], media.get('filesize'))
+  except Exception:
+    app.logger.warning('Failed to probe %s.', media['url'], exc_info=True)
+    metrics.increment('asset_failures_total', {'stage': 'probe'},
+                      url=media['url'])
+    metadata = None
+  
+  return format_entry(entry, metadata,
+                      proxy_thumbnail(thumbnail_source(entry)))
+
+def format_entry(entry, metadata, thumbnail_digest=None):
+  """
+  Merge asset header metadata and the digest of its proxied thumbnail into a
+  feed entry, keeping only the fields the page displays. Metadata of None
+  leaves them unknown. Returns a VideoEntry.
+  """
+  
+  media = entry['media_content'][0]
+  metadata = metadata or {}
   
   # Determine smallest available thumbnail.
   # @NOTE: Requirement 3.
-  entry['thumbnail'] = \
-    sorted(entry['media_thumbnail'], key=lambda k: k['height'])[0]['url']
-
-  # Beautify and populate.
-  date = time.strftime('%l:%M%p on %A, %B %d, %Y', entry['published_parsed'])
+  thumbnails = sorted(entry['media_thumbnail'], key=lambda k: int(k['height']))
   
-  entry['client'] = \
+  # Populate.
+  client = \
     next(s['content'] for s in entry['media_credit'] if s['role'] == 'client')
-  entry['credits'] = sorted(entry['media_credit'], key=lambda k: k['role'])
-  entry['date'] = date.replace('AM', 'am').replace('PM', 'pm')
-  entry['size'] = naturalsize(entry['media_content'][0]['filesize'])
+  keywords = [k.strip() for k in entry.get('media_keywords', '').split(',')]
+  
+  return VideoEntry(
+    id=entry_id(entry),
+    title=entry['title'],
+    link=entry['link'],
+    url=media['url'],
+    width=media.get('width'),
+    height=media.get('height'),
+    filename=entry['summary'] if len(entry['summary']) <= 60 else '<None>',
+    client=client,
+    credits=tuple(sorted((c['role'], c['content'])
+                         for c in entry['media_credit'])),
+    keywords=tuple(sorted(k for k in keywords if k)),
+    published=calendar.timegm(entry['published_parsed']),
+    duration=metadata.get('duration'),
+    bitrate=metadata.get('bitrate'),
+    codec=metadata.get('codec'),
+    size=int(media['filesize']) if media.get('filesize') else None,
+    thumbnail=thumbnails[0]['url'],
+    thumbnail_digest=thumbnail_digest)
+
+def thumbnail_path(digest):
+  return os.path.join(thumbnail_dir, digest + '.jpg')
+
+def thumbnail_source(entry):
+  """
+  Pick the thumbnail of a feed entry to proxy: the smallest that still fills
+  the display box, or else the largest. Returns its URL.
+  """
+  
+  thumbnails = sorted(entry['media_thumbnail'], key=lambda k: int(k['height']))
+  source = next((t for t in thumbnails
+                 if int(t['height']) >= thumbnail_height), thumbnails[-1])
+  
+  return source['url']
+
+def cached_thumbnail(url):
+  """
+  Return the digest of a thumbnail already stored on disk, or None.
+  """
+  
+  digest = asset_cache.get('thumbnail:' + url)
+  
+  if digest is not None and os.path.exists(thumbnail_path(digest)):
+    metrics.increment('cache_requests_total',
+                      {'cache': 'thumbnail', 'result': 'hit'}, url=url)
+    return digest
+  
+  metrics.increment('cache_requests_total',
+                    {'cache': 'thumbnail', 'result': 'miss'}, url=url)
+  
+  return None
+
+def fetch_thumbnail(url):
+  """
+  GET a thumbnail from the CDN. Returns its content.
+  """
+  
+  with metrics.timer('thumbnail_fetch', url=url), cdn_slots:
+    response = session.get(url, timeout=cdn_timeout)
+    response.raise_for_status()
+  
+  metrics.increment('cdn_bytes_total', {'kind': 'thumbnail'},
+                    len(response.content), url=url)
+  
+  return response.content
+
+def proxy_thumbnail(url, content=None):
+  """
+  Store a thumbnail as store_thumbnail does, logging rather than raising any
+  failure. Returns the digest, or None.
+  """
+  
+  try:
+    return store_thumbnail(url, content)
+  except Exception:
+    app.logger.warning('Failed to proxy thumbnail %s.', url, exc_info=True)
+  
+  return None
+
+def store_thumbnail(url, content=None):
+  """
+  Fetch a thumbnail once, resize it to the display box and re-encode it as a
+  compact JPEG, stored on disk under the digest of its content. Content already
+  fetched, e.g. by the pipeline's I/O stage, is stored as given. Returns the
+  digest.
+  """
+  
+  if content is None:
+    digest = cached_thumbnail(url)
+    
+    if digest is not None:
+      return digest
+    
+    content = fetch_thumbnail(url)
+  
+  # Scale to cover the box, as the template crops it to fit.
+  with metrics.timer('thumbnail_resize', url=url):
+    image = Image.open(StringIO(content)).convert('RGB')
+    scale = max(float(thumbnail_width) / image.size[0],
+                float(thumbnail_height) / image.size[1])
+    
+    if scale < 1:
+      image = image.resize((int(round(image.size[0] * scale)),
+                            int(round(image.size[1] * scale))), Image.LANCZOS)
+    
+    output = StringIO()
+    image.save(output, 'JPEG', quality=thumbnail_quality, optimize=True,
+               progressive=True)
+    data = output.getvalue()
+  digest = hashlib.sha1(data).hexdigest()
+  
+  # Write atomically, so concurrent readers never see a partial file.
+  if not os.path.exists(thumbnail_path(digest)):
+    handle, temporary = tempfile.mkstemp(dir=thumbnail_dir, suffix='.tmp')
+    
+    with os.fdopen(handle, 'wb') as thumbnail:
+      thumbnail.write(data)
+    
+    os.rename(temporary, thumbnail_path(digest))
+    prune_thumbnails()
+  
+  asset_cache.set('thumbnail:' + url, digest)
+  asset_cache.set('thumbnail-source:' + digest, url)
+  
+  return digest
+
+def prune_thumbnails():
+  """
+  Evict the least recently served thumbnails past thumbnail_threshold. Serving
+  a thumbnail bumps its modification time.
+  """
+  
+  names = [n for n in os.listdir(thumbnail_dir) if n.endswith('.jpg')]
+  
+  if len(names) <= thumbnail_threshold:
+    return
+  
+  paths = sorted((os.path.join(thumbnail_dir, n) for n in names),
+                 key=os.path.getmtime)
+  
+  for path in paths[:len(paths) - thumbnail_threshold]:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+def private_directory(path):
+  """
+  Create a directory only this user can write to, or check an existing one is,
+  along with every directory above it. Anyone able to plant files there could
+  have the app load their cache entries, which are pickles, or their snapshots.
+  Raises OSError to refuse one that isn't.
+  """
+  
+  try:
+    os.makedirs(path, 0700)
+  except OSError:
+    if not os.path.isdir(path):
+      raise
   
-  if len(entry['summary']) > 60:
-    entry['summary'] = '<None>'
+  info = os.lstat(path)
   
-  return entry
+  if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid() or \
+     info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+    raise OSError('Refusing to use %s: it must be a directory owned and only '
+                  'writable by uid %d.' % (path, os.geteuid()))
+  
+  # Parents may be shared, e.g. /tmp, as long as they are sticky, so no one
+  # else can move this directory out of the way.
+  parent = os.path.realpath(os.path.dirname(os.path.abspath(path)))
+  
+  while True:
+    info = os.lstat(parent)
+    
+    if info.st_uid not in (0, os.geteuid()) or \
+       (info.st_mode & (stat.S_IWGRP | stat.S_IWOTH) and
+        not info.st_mode & stat.S_ISVTX):
+      raise OSError('Refusing to use %s: %s is writable by other users.' %
+                    (path, parent))
+    
+    if parent == os.path.dirname(parent):
+      break
+    
+    parent = os.path.dirname(parent)
+
+def create_cache(backend, namespace, threshold, timeout):
+  """
+  Create a cache for the configured backend. Namespaces keep the feed and asset
+  caches apart where they share storage. Returns a werkzeug cache instance.
+  """
+  
+  if backend == 'simple':
+    return SimpleCache(threshold=threshold, default_timeout=timeout)
+  elif backend == 'filesystem':
+    return FileSystemCache(os.path.join(cache_dir, namespace),
+                           threshold=threshold, default_timeout=timeout)
+  elif backend == 'redis':
+    return RedisCache(host=redis_host, port=redis_port,
+                      default_timeout=timeout, key_prefix=namespace + ':')
+  
+  raise ValueError('Unrecognized cache backend "%s".' % backend)
+
+def create_fetch_pool(mode, workers):
+  """
+  Create the long-lived worker pool used to fetch and decode video headers.
+  Returns a thread or process pool bounded to the given number of workers.
+  """
+  
+  if mode == 'thread':
+    return ThreadPool(workers)
+  elif mode == 'process':
+    return Pool(workers)
+  
+  raise ValueError('Unrecognized fetch mode "%s".' % mode)
+
+@app.before_first_request
+def start_workers():
+  """
+  Create the fetch pools and start the background refresher, once per process.
+  Runs on the first request, or the first fetch outside of one, so only a
+  process that serves starts them: not the reloader's watcher under
+  `python app.py`, nor a parent forking workers after import (gunicorn
+  --preload), whose threads wouldn't survive the fork.
+  """
+  
+  global fetch_pool, io_pool
+  
+  with workers_lock:
+    if fetch_pool is not None:
+      return
+    
+    fetch_pool = create_fetch_pool(fetch_mode, fetch_workers)
+    
+    if fetch_engine == 'pipeline':
+      io_pool = create_fetch_pool('thread', io_workers)
+    
+    if refresh_in_background:
+      refresher.start()
+
+def shutdown_fetch_pool():
+  """
+  Stop accepting work and wait for in-flight fetches to finish on exit.
+  """
+  
+  for pool in (io_pool, fetch_pool):
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+def guarded(function, argument):
+  """
+  Call function in a pool worker. Returns a (result, None) tuple, or (None,
+  exception) if it raised, as apply_async callbacks never see errors.
+  """
+  
+  try:
+    return function(argument), None
+  except Exception as error:
+    return None, error
+
+def iter_entries(entries, deadline=None):
+  """
+  Distribute decoding operations for feed entries to the shared fetch pool.
+  Returns an iterator of VideoEntry objects, in the order they finish. Entries
+  still unfinished at the deadline are yielded last, with metadata unknown.
+  """
+  
+  start_workers()
+  
+  # Parallelize fetches. The pipeline engine queues each entry for parsing as
+  # soon as its header bytes arrive, from the I/O pool's result callback, so
+  # no pool thread ever blocks waiting on the other pool.
+  if fetch_engine == 'pipeline':
+    finished = Queue.Queue()
+    
+    def parse(result):
+      prefetched, error = result
+      
+      if error is not None:
+        finished.put((None, error))
+      else:
+        fetch_pool.apply_async(guarded, (finish_entry, prefetched),
+                               callback=finished.put)
+    
+    for entry in entries:
+      io_pool.apply_async(guarded, (prefetch_asset, entry), callback=parse)
+    
+    next_entry = lambda timeout: finished.get(timeout=timeout)
+  else:
+    results = fetch_pool.imap_unordered(parse_metadata, entries)
+    next_entry = lambda timeout: (results.next(timeout), None)
+  
+  pending = dict((entry_id(e), e) for e in entries)
+  
+  for index in range(len(entries)):
+    try:
+      if deadline is None:
+        entry, error = next_entry(None)
+      else:
+        entry, error = next_entry(max(deadline - time.time(), 0))
+    except (TimeoutError, Queue.Empty):
+      break
+    
+    if error is not None:
+      raise error
+    
+    pending.pop(entry.id, None)
+    yield entry
+  
+  # Stragglers keep running in the pool, and may finish in time for a retry.
+  for entry in pending.values():
+    app.logger.warning('Gave up waiting on %s.', entry_id(entry))
+    metrics.increment('asset_failures_total', {'stage': 'deadline'},
+                      url=entry['media_content'][0]['url'])
+    
+    yield format_entry(entry, None)
+
+def fetch_feed(url, etag=None, modified=None):
+  """
+  GET a feed through the shared session, conditionally if given validators.
+  Returns a feedparser result, with the response's status and validators.
+  """
+  
+  headers = {}
+  
+  if etag:
+    headers['If-None-Match'] = etag
+  
+  if modified:
+    headers['If-Modified-Since'] = modified
+  
+  with metrics.timer('feed', url=url):
+    response = session.get(url, headers=headers, timeout=cdn_timeout)
+    response.raise_for_status()
+    
+    if response.status_code == 304:
+      feed = feedparser.FeedParserDict(entries=[])
+    else:
+      feed = feedparser.parse(response.content)
+  
+  feed['status'] = response.status_code
+  
+  for key, header in (('etag', 'ETag'), ('modified', 'Last-Modified')):
+    if header in response.headers:
+      feed[key] = response.headers[header]
+  
+  return feed
 
 def parse_rss_feed(url):
   """
   Parse RSS feed from URL argument, then distribute decoding operations to
-  subprocesses. Returns a list of video metadata dictionaries.
+  the shared fetch pool. Returns a list of VideoEntry objects.
   """
   
   # Parse RSS feed items into dictionaries.
   # @NOTE: Requirement 1.
-  feed = feedparser.parse(url)
+  feed = fetch_feed(url)
   
-  # Parallelize fetches.
-  parallelize = Pool(15)
-  entries = parallelize.map(parse_metadata, feed['entries'])
+  return list(iter_entries(feed['entries'], time.time() + rebuild_budget))
 
-  return entries
+def entry_id(entry):
+  return entry.get('id') or entry.get('link')
+
+def fingerprint(entry):
+  """
+  Digest a raw feed entry, so changed entries can be told apart from ones
+  already parsed into a snapshot. Also digests whole snapshots.
+  """
+  
+  # Slotted entries digest by their field values, anything else by its text.
+  encode = lambda o: o.__getstate__() if isinstance(o, VideoEntry) else str(o)
+  digest = hashlib.sha1(json.dumps(entry, sort_keys=True, default=encode))
+  
+  return digest.hexdigest()
+
+def rebuild_snapshot(feed_uri, previous, progress):
+  """
+  Refresh a snapshot with a conditional GET of the feed. On a 304 the previous
+  snapshot is kept as it is, sharing its entries and index, with only a new
+  expiry. Otherwise entries are diffed by GUID: only new or changed ones are
+  parsed, and ones gone from the feed are dropped. Returns a new snapshot
+  dictionary.
+  
+  Entries are waited on for at most rebuild_budget seconds. Ones left with
+  unknown metadata aren't fingerprinted, so the next rebuild parses them again,
+  and the snapshot expires early to bring that rebuild forward.
+  """
+  
+  previous = previous or {}
+  deadline = time.time() + rebuild_budget
+  
+  # Parse RSS feed items into dictionaries. Retries need every entry, so they
+  # skip the conditional GET.
+  # @NOTE: Requirement 1.
+  if previous.get('retries'):
+    feed = fetch_feed(cdn + feed_uri)
+  else:
+    feed = fetch_feed(cdn + feed_uri, previous.get('etag'),
+                      previous.get('modified'))
+  
+  progress.start()
+  
+  # Retries skip the conditional GET, so a 304 means no entry is unknown.
+  if feed['status'] == 304 and 'data' in previous:
+    progress.add(previous['data'])
+    
+    return dict(previous, expires=time.time() + cache_timeout)
+  
+  known = dict((e.id, e) for e in previous.get('data', []))
+  fingerprints = {}
+  changed = []
+  
+  for entry in feed['entries']:
+    key = entry_id(entry)
+    fingerprints[key] = fingerprint(entry)
+    
+    if key in known and \
+       previous.get('fingerprints', {}).get(key) == fingerprints[key]:
+      progress.add([known[key]])
+    else:
+      changed.append(entry)
+  
+  for entry in iter_entries(changed, deadline):
+    progress.add([entry])
+  
+  data = sorted(progress.entries, key=lambda k: k.title)
+  
+  # Every probe yields a duration, so entries without one are unknown.
+  incomplete = set(e.id for e in data if e.duration is None)
+  retries = previous.get('retries', 0) + 1 if incomplete else 0
+  expires = time.time() + cache_timeout
+  
+  if incomplete:
+    app.logger.warning('Metadata unknown for %d of %d entries in %s.',
+                       len(incomplete), len(data), feed_uri)
+    expires = min(expires, time.time() +
+                  metadata_retry_delay * 2 ** (retries - 1))
+  
+  return {
+    'data': data,
+    'index': build_index(data),
+    'expires': expires,
+    'version': fingerprint(data),
+    'etag': feed.get('etag', previous.get('etag')),
+    'modified': feed.get('modified', previous.get('modified')),
+    'fingerprints': dict((k, v) for k, v in fingerprints.items()
+                         if k not in incomplete),
+    'retries': retries
+  }
+
+def build_index(data):
+  """
+  Precompute every ordering and filter a feed page can ask for, as lists of
+  positions into data, so serving a page only slices a list. Returns an index
+  dictionary of orderings, plus orderings per client and per keyword.
+  """
+  
+  index = {'order': {}, 'client': {}, 'keyword': {}}
+  ranks = {}
+  
+  for sort, (key, reverse) in sort_keys.items():
+    order = sorted(range(len(data)), key=lambda i: key(data[i]),
+                   reverse=reverse)
+    index['order'][sort] = order
+    ranks[sort] = [0] * len(data)
+    
+    for rank, position in enumerate(order):
+      ranks[sort][position] = rank
+  
+  matches = {'client': {}, 'keyword': {}}
+  
+  for position, entry in enumerate(data):
+    matches['client'].setdefault(entry.client, []).append(position)
+    
+    for keyword in set(entry.keywords):
+      matches['keyword'].setdefault(keyword, []).append(position)
+  
+  for field, values in matches.items():
+    for value, positions in values.items():
+      index[field][value] = dict(
+        (sort, sorted(positions, key=ranks[sort].__getitem__))
+        for sort in sort_keys)
+  
+  return index
+
+def select_entries(snapshot, sort, client, keyword, page):
+  """
+  Look up one page of a snapshot's entries through its index. Returns the
+  entries, and a pager dictionary of page, page count and total.
+  """
+  
+  data = snapshot['data']
+  index = snapshot.get('index') or build_index(data)
+  positions = index['order'][sort]
+  
+  if client:
+    positions = index['client'].get(client, {}).get(sort, [])
+  
+  if keyword:
+    keyword_positions = index['keyword'].get(keyword, {}).get(sort, [])
+    
+    # Both filters: walk the keyword's ordering, keeping the client's entries.
+    if client:
+      wanted = set(positions)
+      positions = [p for p in keyword_positions if p in wanted]
+    else:
+      positions = keyword_positions
+  
+  pages = max((len(positions) + page_size - 1) // page_size, 1)
+  page = min(max(page, 1), pages)
+  start = (page - 1) * page_size
+  
+  entries = [data[p] for p in positions[start:start + page_size]]
+  
+  return entries, {'page': page, 'pages': pages, 'total': len(positions)}
+
+def refresh_snapshot(feed_uri, progress, ahead=0):
+  """
+  Return the cached feed snapshot if still fresh, otherwise rebuild and cache
+  it. Meant to be run through SingleFlight, so the re-check lets callers that
+  queued behind a finished rebuild reuse its result. Entries are published to
+  progress as they are parsed. Snapshots due to expire within ahead seconds are
+  rebuilt early.
+  """
+  
+  snapshot = load_snapshot(feed_uri, progress, ahead)
+  
+  # Snapshots that weren't rebuilt here arrive whole.
+  if not progress.entries:
+    progress.add(snapshot['data'])
+  
+  # Feeds that built successfully are kept warm from now on.
+  track_feed(feed_uri, served=False)
+  
+  return snapshot
+
+def load_snapshot(feed_uri, progress, ahead=0):
+  """
+  Return a fresh or stale cached snapshot, or rebuild one. Returns a snapshot
+  dictionary of sorted entries and expiry time.
+  """
+  
+  snapshot = cached_snapshot(feed_uri) or restore_snapshot(feed_uri)
+  
+  if snapshot is not None and snapshot['expires'] - ahead > time.time():
+    return snapshot
+  
+  # Only one worker process rebuilds at a time. The rest keep serving a stale
+  # copy, or wait for the rebuilding worker to publish one. Should it give up
+  # without one, or die and let its lock expire, a waiter rebuilds instead.
+  lock = 'rebuild:' + feed_uri
+  token = acquire_lock(lock, rebuild_lock_timeout)
+  
+  if token is None and snapshot is not None:
+    return snapshot
+  
+  while token is None:
+    time.sleep(0.5)
+    snapshot = cached_snapshot(feed_uri)
+    
+    if snapshot is not None:
+      return snapshot
+    
+    token = acquire_lock(lock, rebuild_lock_timeout)
+  
+  try:
+    previous = snapshot
+    version = snapshot and snapshot['version']
+    started = time.time()
+    
+    with metrics.timer('rebuild', feed=feed_uri):
+      snapshot = rebuild_snapshot(feed_uri, previous, progress)
+    
+    # An unchanged feed (a 304) only moves the expiry in the header.
+    if previous is not None and snapshot['data'] is previous['data']:
+      cache_snapshot_header(feed_uri, snapshot)
+    else:
+      cache_snapshot(feed_uri, snapshot)
+    
+    if snapshot['version'] != version:
+      save_snapshot(feed_uri, snapshot)
+  finally:
+    if not release_lock(lock, token):
+      app.logger.warning('Rebuild of %s outlived its lock.', feed_uri)
+  
+  unknown = [e for e in snapshot['data'] if e.duration is None]
+  metrics.event('rebuild', feed=feed_uri,
+                seconds=round(time.time() - started, 3),
+                entries=len(snapshot['data']), unknown=len(unknown),
+                changed=snapshot['version'] != version)
+  
+  # Retry unknown metadata as soon as the snapshot expires, rather than on the
+  # next request or refresher run.
+  if snapshot['retries']:
+    schedule_rebuild(feed_uri, snapshot['expires'])
+  
+  return snapshot
+
+def cache_snapshot(feed_uri, snapshot, add=False):
+  """
+  Cache a feed snapshot, then the small header of version and expiry requests
+  look it up by. With add=True, a snapshot already cached is kept instead.
+  Returns whether the snapshot was cached.
+  """
+  
+  timeout = cache_timeout + cache_stale_timeout
+  
+  if add:
+    if not cache.add('snapshot:' + feed_uri, snapshot, timeout=timeout):
+      return False
+  else:
+    cache.set('snapshot:' + feed_uri, snapshot, timeout=timeout)
+  
+  cache_snapshot_header(feed_uri, snapshot)
+  
+  return True
+
+def cache_snapshot_header(feed_uri, snapshot):
+  """
+  Cache the header of a snapshot alone. Its expiry overrides the one cached
+  with the snapshot itself.
+  """
+  
+  cache.set('snapshot-header:' + feed_uri,
+            {'version': snapshot['version'], 'expires': snapshot['expires']},
+            timeout=cache_timeout + cache_stale_timeout)
+
+def cached_snapshot(feed_uri):
+  """
+  Return a feed's cached snapshot, or None. Each worker keeps the snapshots it
+  last decoded, and only reads one from the cache again once its header shows
+  a new version, so serving a page doesn't unpickle the whole feed.
+  """
+  
+  header = cache.get('snapshot-header:' + feed_uri)
+  
+  if header is None:
+    return None
+  
+  with decoded_lock:
+    snapshot = decoded.get(feed_uri)
+  
+  if snapshot is None or snapshot['version'] != header['version']:
+    snapshot = cache.get('snapshot:' + feed_uri)
+    
+    if snapshot is None:
+      return None
+    
+    with decoded_lock:
+      decoded.pop(feed_uri, None)
+      decoded[feed_uri] = snapshot
+      
+      while len(decoded) > max_feeds:
+        decoded.popitem(last=False)
+  
+  # Revalidating an unchanged feed extends its expiry, not its version.
+  return dict(snapshot, expires=header['expires'])
+
+def lock_path(name):
+  slot = int(hashlib.sha1(name).hexdigest(), 16) % lock_slots
+  
+  return os.path.join(cache_dir, 'locks', '%02d' % slot)
+
+def read_owners(handle):
+  """
+  Read the owners recorded in a lock file, as a dict of lock name to (token,
+  expiry), dropping any that have expired.
+  """
+  
+  os.lseek(handle, 0, os.SEEK_SET)
+  data = ''
+  
+  while True:
+    chunk = os.read(handle, 64 * 1024)
+    
+    if not chunk:
+      break
+    
+    data += chunk
+  
+  try:
+    owners = json.loads(data or '{}')
+  except ValueError:
+    owners = {}
+  
+  now = time.time()
+  
+  return dict((name, owner) for name, owner in owners.items()
+              if owner[1] > now)
+
+def write_owners(handle, owners):
+  os.lseek(handle, 0, os.SEEK_SET)
+  os.ftruncate(handle, 0)
+  os.write(handle, json.dumps(owners))
+
+@contextmanager
+def locked_file(path):
+  """
+  Open a file, creating it if need be, and hold an exclusive flock on it for
+  the duration. The kernel drops the flock should the process die. Yields the
+  file descriptor.
+  """
+  
+  handle = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+  
+  try:
+    fcntl.flock(handle, fcntl.LOCK_EX)
+    yield handle
+  finally:
+    os.close(handle)
+
+def acquire_lock(name, timeout):
+  """
+  Take a named lock, shared by every worker using the cache backend, for up to
+  timeout seconds. A lock held past its timeout counts as free. Returns an owner
+  token to release it with, or None if another worker holds it.
+  """
+  
+  token = '%d-%s' % (os.getpid(), os.urandom(8).encode('hex'))
+  expires = time.time() + timeout
+  
+  if cache_backend == 'redis':
+    # Redis expires the key itself.
+    if cache._client.set(cache.key_prefix + 'lock:' + name, token, nx=True,
+                         px=int(timeout * 1000)):
+      return token
+    
+    return None
+  elif cache_backend == 'filesystem':
+    # Each lock file holds the token and expiry of every lock hashed to it,
+    # read and written under a flock, so taking a lock is atomic between
+    # processes.
+    with locked_file(lock_path(name)) as handle:
+      owners = read_owners(handle)
+      
+      if name in owners:
+        return None
+      
+      owners[name] = (token, expires)
+      write_owners(handle, owners)
+    
+    return token
+  
+  with locks_lock:
+    owner = locks.get(name)
+    
+    if owner is not None and owner[1] > time.time():
+      return None
+    
+    locks[name] = (token, expires)
+  
+  return token
+
+def release_lock(name, token):
+  """
+  Release a lock taken by acquire_lock, unless it has since expired and been
+  taken by another worker. Returns whether the token still owned it.
+  """
+  
+  if cache_backend == 'redis':
+    # Compare and delete in one step.
+    return bool(cache._client.eval(
+      "if redis.call('get', KEYS[1]) == ARGV[1] then "
+      "return redis.call('del', KEYS[1]) end return 0",
+      1, cache.key_prefix + 'lock:' + name, token))
+  elif cache_backend == 'filesystem':
+    with locked_file(lock_path(name)) as handle:
+      owners = read_owners(handle)
+      
+      if owners.get(name, (None,))[0] != token:
+        return False
+      
+      del owners[name]
+      write_owners(handle, owners)
+    
+    return True
+  
+  with locks_lock:
+    if locks.get(name, (None,))[0] != token:
+      return False
+    
+    del locks[name]
+  
+  return True
+
+def schedule_rebuild(feed_uri, when):
+  """
+  Rebuild a feed snapshot in the background, at the given time.
+  """
+  
+  refresh = lambda progress: refresh_snapshot(feed_uri, progress)
+  timer = threading.Timer(max(when - time.time(), 0), flight.spawn,
+                          (feed_uri, refresh))
+  timer.daemon = True
+  timer.start()
+
+def snapshot_path(feed_uri):
+  return os.path.join(snapshot_dir,
+                      hashlib.sha1(feed_uri).hexdigest() + '.snapshot')
+
+def save_snapshot(feed_uri, snapshot):
+  """
+  Write a snapshot to disk, with the cached asset and thumbnail metadata its
+  entries were built from. Written atomically, as a format header followed by
+  compressed JSON, so loading one can't run code; the index is left out and
+  rebuilt on load.
+  """
+  
+  assets = {}
+  
+  for entry in snapshot['data']:
+    key = asset_key(entry.url, entry.size)
+    metadata = asset_cache.get(key)
+    
+    if metadata is not None:
+      assets[key] = metadata
+    
+    # Thumbnails are looked up both ways round.
+    if entry.thumbnail_digest:
+      source = asset_cache.get('thumbnail-source:' + entry.thumbnail_digest)
+      
+      if source is not None:
+        assets['thumbnail-source:' + entry.thumbnail_digest] = source
+        assets['thumbnail:' + source] = entry.thumbnail_digest
+  
+  payload = {
+    'feed': feed_uri,
+    'snapshot': dict((k, v) for k, v in snapshot.items()
+                     if k not in ('data', 'index')),
+    'data': [entry.__getstate__() for entry in snapshot['data']],
+    'assets': assets
+  }
+  
+  try:
+    data = zlib.compress(json.dumps(payload))
+  except (TypeError, ValueError):
+    app.logger.warning('Failed to encode snapshot of %s.', feed_uri,
+                       exc_info=True)
+    return
+  
+  try:
+    handle, temporary = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+    
+    with os.fdopen(handle, 'wb') as output:
+      output.write(snapshot_magic + struct.pack('>H', snapshot_format) + data)
+    
+    os.rename(temporary, snapshot_path(feed_uri))
+  except (IOError, OSError):
+    app.logger.warning('Failed to save snapshot of %s.', feed_uri,
+                       exc_info=True)
+
+def restore_snapshot(feed_uri):
+  """
+  Load a feed's snapshot saved by an earlier run, put it back in the cache and
+  seed the asset cache with its metadata. Returns the snapshot, or None when
+  there is no readable one in the current format.
+  """
+  
+  try:
+    with open(snapshot_path(feed_uri), 'rb') as saved:
+      data = saved.read()
+  except IOError:
+    return None
+  
+  header = len(snapshot_magic) + 2
+  
+  if data[:header] != snapshot_magic + struct.pack('>H', snapshot_format):
+    app.logger.warning('Ignoring snapshot of %s in an old format.', feed_uri)
+    return None
+  
+  try:
+    payload = json.loads(zlib.decompress(data[header:]))
+    snapshot = payload['snapshot']
+    snapshot['data'] = [VideoEntry.from_state(s) for s in payload['data']]
+  except Exception:
+    app.logger.warning('Ignoring unreadable snapshot of %s.', feed_uri,
+                       exc_info=True)
+    return None
+  
+  if payload['feed'] != feed_uri:
+    return None
+  
+  snapshot['index'] = build_index(snapshot['data'])
+  
+  for key, value in payload['assets'].items():
+    asset_cache.add(key, value)
+  
+  # Another worker may have restored or rebuilt it first.
+  if not cache_snapshot(feed_uri, snapshot, add=True):
+    return cached_snapshot(feed_uri) or snapshot
+  
+  app.logger.info('Restored snapshot of %s, %d entries.', feed_uri,
+                  len(snapshot['data']))
+  
+  return snapshot
+
+def track_feed(feed_uri, served=True):
+  """
+  Record a feed as served, so the refresher keeps it warm. Only the max_feeds
+  most recently served feeds are tracked. With served=False, a feed not yet
+  tracked is added without refreshing its place.
+  """
+  
+  with feeds_lock:
+    if not served and feed_uri in feeds:
+      return
+    
+    feeds.pop(feed_uri, None)
+    feeds[feed_uri] = time.time()
+    
+    while len(feeds) > max_feeds:
+      feeds.popitem(last=False)
+
+def background_refresh():
+  """
+  Rebuild every tracked feed snapshot ahead of its expiry, joining any rebuild
+  already in flight, and stop tracking feeds left idle. Run by the refresher.
+  """
+  
+  ahead = refresh_interval * (1 + refresh_jitter)
+  failures = 0
+  
+  with feeds_lock:
+    tracked = feeds.items()
+  
+  for feed_uri, served in tracked:
+    if feed_uri != uri and served + feed_idle_timeout < time.time():
+      with feeds_lock:
+        feeds.pop(feed_uri, None)
+      
+      continue
+    
+    try:
+      flight.do(feed_uri,
+                lambda progress: refresh_snapshot(feed_uri, progress, ahead))
+    except Exception:
+      app.logger.exception('Failed to refresh feed %s.', feed_uri)
+      failures += 1
+  
+  if failures:
+    raise IOError('Failed to refresh %d of %d feeds.' %
+                  (failures, len(tracked)))
+
+################################################################################
+# Caches, HTTP session and worker pools, created once at startup and shared by
+# every request.
+
+# Metrics lines go out one per line, whatever Flask's own logging is set to.
+metrics_log = logging.getLogger('wiredrive.metrics')
+metrics_log.setLevel(metrics_log_level)
+metrics_log.propagate = False
+
+if not metrics_log.handlers:
+  handler = logging.StreamHandler()
+  handler.setFormatter(logging.Formatter('time=%(asctime)s %(message)s',
+                                         '%Y-%m-%dT%H:%M:%S'))
+  metrics_log.addHandler(handler)
+
+metrics = Metrics('wiredrive', {
+  'stage_seconds': 'Time spent in each feed pipeline stage.',
+  'asset_fetched_bytes': 'Bytes fetched from the CDN to probe one asset.',
+  'cdn_bytes_total': 'Bytes fetched from the CDN, by kind.',
+  'cache_requests_total': 'Cache lookups, by cache and result.',
+  'asset_failures_total': 'Assets left with unknown metadata, by stage.'
+}, metrics_log)
+
+if cache_backend == 'filesystem':
+  private_directory(cache_dir)
+
+cache = create_cache(cache_backend, 'feed', cache_threshold,
+                     cache_timeout + cache_stale_timeout)
+asset_cache = create_cache(cache_backend, 'asset', asset_cache_threshold,
+                           asset_cache_timeout)
+page_cache = create_cache(cache_backend, 'page', page_cache_threshold,
+                          cache_timeout + cache_stale_timeout)
+
+# Snapshots this worker last decoded from the cache, least recently first.
+decoded = OrderedDict()
+decoded_lock = threading.Lock()
+
+# Connection failures and 5xx responses are retried with exponential backoff.
+retry = Retry(total=cdn_retries, backoff_factor=cdn_retry_backoff,
+              status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_maxsize=cdn_connections,
+                                     max_retries=retry))
+session.mount('https://', HTTPAdapter(pool_maxsize=cdn_connections,
+                                      max_retries=retry))
+cdn_slots = threading.BoundedSemaphore(cdn_connections)
+
+private_directory(thumbnail_dir)
+
+# Cross-worker locks, e.g. on feed rebuilds. The filesystem backend keeps them
+# in lock_slots lock files beside the caches; 'simple' caches are per process,
+# and so are their locks.
+locks = {}
+locks_lock = threading.Lock()
+
+if cache_backend == 'filesystem':
+  private_directory(os.path.join(cache_dir, 'locks'))
+
+flight = SingleFlight()
+asset_flight = SingleFlight()
+
+# Saved snapshot files start with a magic string and format version. Bump the
+# version whenever the snapshot or VideoEntry layout changes.
+snapshot_magic = 'WDSNAP'
+snapshot_format = 2
+
+private_directory(snapshot_dir)
+
+# Feeds the refresher keeps warm, least recently served first.
+feeds = OrderedDict([(uri, time.time())])
+feeds_lock = threading.Lock()
+
+# Fetch pools and the refresher, started by start_workers. Process pool workers
+# fork then, once everything they use exists.
+fetch_pool = None
+io_pool = None
+workers_lock = threading.Lock()
+
+atexit.register(shutdown_fetch_pool)
+
+refresher = Refresher(background_refresh, refresh_interval, refresh_jitter,
+                      refresh_backoff, refresh_backoff_max)
 
 ################################################################################
 # Routes, views and main method.
 
-@app.route('/')
-def display_feed():
+@app.template_filter()
+def format_duration(seconds):
+  if seconds is None:
+    return None
+  
+  minutes, seconds = divmod(int(seconds), 60)
+  
+  return '%sm %ss' % (minutes, seconds)
+
+@app.template_filter()
+def format_bitrate(bitrate):
+  if bitrate is None:
+    return None
+  
+  return '{0:,} kb/s'.format(int(bitrate / 1024))
+
+@app.template_filter()
+def format_size(size):
+  return naturalsize(size) if size is not None else None
+
+@app.template_filter()
+def format_date(timestamp):
+  date = time.strftime('%l:%M%p on %A, %B %d, %Y', time.gmtime(timestamp))
+  
+  return date.replace('AM', 'am').replace('PM', 'pm')
+
+def stream_template(template_name, **context):
+  """
+  Render a template piece by piece, so a response can flush each entry as soon
+  as the context's iterables produce it.
+  """
+  
+  app.update_template_context(context)
+  
+  return app.jinja_env.get_template(template_name).stream(context)
+
+def render_feed(feed_uri):
   """
   Fetch and render list of video metadata dictionaries in a web application, and
   attempt to cache the results.
   """
   
-  data = cache.get('data')
+  snapshot = cached_snapshot(feed_uri)
+  restored = False
+  
+  # After a restart, serve the snapshot saved by the last run.
+  if snapshot is None:
+    snapshot = restore_snapshot(feed_uri)
+    restored = snapshot is not None
+  
+  if snapshot is None:
+    result = 'miss'
+  elif restored:
+    result = 'restored'
+  else:
+    result = 'stale' if snapshot['expires'] <= time.time() else 'hit'
+  
+  if snapshot is not None:
+    track_feed(feed_uri)
   
-  if data is None:
-    data = sorted(parse_rss_feed(cdn + uri), key=lambda k: k['title'])
-    cache.set('data', data, timeout=24 * 60 * 60)
+  metrics.increment('cache_requests_total',
+                    {'cache': 'snapshot', 'result': result}, feed=feed_uri)
+  
+  # Cold cache: follow the one in-flight rebuild, streaming entries out as they
+  # are parsed or waiting for all of them. Stale cache: serve it as is, and
+  # unless the refresher is already on it, revalidate in the background. A
+  # restored snapshot is revalidated right away either way.
+  refresh = lambda progress: refresh_snapshot(feed_uri, progress)
+  
+  if snapshot is None and stream_cold_render and not request.args:
+    progress = flight.spawn(feed_uri, refresh)
+    
+    # Only commit to a streamed 200 once the feed itself has been fetched.
+    error = progress.wait_started()
+    
+    if error is not None:
+      abort_feed(feed_uri, error)
+    
+    return Response(stream_with_context(stream_template('index.html',
+                                                        data=progress)))
+  elif snapshot is None:
+    try:
+      snapshot = flight.do(feed_uri, refresh)
+    except requests.RequestException as error:
+      abort_feed(feed_uri, error)
+  elif snapshot['expires'] <= time.time() and \
+       (restored or not refresh_in_background):
+    flight.spawn(feed_uri, refresh)
+  
+  query = {
+    'sort': request.args.get('sort', 'title'),
+    'client': request.args.get('client', ''),
+    'keyword': request.args.get('keyword', ''),
+    'page': request.args.get('page', 1, type=int)
+  }
+  
+  if query['sort'] not in sort_keys:
+    abort(400)
+  
+  return page_response(render_page(feed_uri, snapshot, query))
+
+def abort_feed(feed_uri, error):
+  """
+  Answer a request for a feed that couldn't be built: 404 if the CDN has no
+  such feed, or 502 if the CDN failed or couldn't be reached. Any other error
+  is raised again.
+  """
+  
+  if not isinstance(error, requests.RequestException):
+    raise error
+  
+  if error.response is not None and error.response.status_code == 404:
+    abort(404)
+  
+  app.logger.warning('Failed to fetch feed %s: %s', feed_uri, error)
+  abort(502)
+
+def render_page(feed_uri, snapshot, query):
+  """
+  Return one rendered page of a feed, along with compressed copies of it.
+  Unfiltered pages are cached in the page cache, and only rendered again once
+  the snapshot's data changes. Returns a page dictionary.
+  """
+  
+  key = None
+  entries, pager = select_entries(snapshot, **query)
+  query['page'] = pager['page']
+  
+  # Filtered pages are too many to be worth caching. Page numbers are clamped
+  # first, so out of range ones can't add cache entries.
+  if not query['client'] and not query['keyword']:
+    key = 'html:%s?sort=%s&page=%d' % (feed_uri, query['sort'], query['page'])
+    page = page_cache.get(key)
+    hit = page is not None and page['version'] == snapshot.get('version')
+    
+    metrics.increment('cache_requests_total',
+                      {'cache': 'page', 'result': 'hit' if hit else 'miss'},
+                      page=key)
+    
+    if hit:
+      return page
+  
+  # Links to neighbouring pages and other orderings keep the current filters.
+  for direction, number in (('previous', pager['page'] - 1),
+                            ('next', pager['page'] + 1)):
+    if 1 <= number <= pager['pages']:
+      pager[direction] = query_string(query, page=number)
+  
+  pager['sorts'] = [(sort, query_string(query, sort=sort, page=1))
+                    for sort in sorted(sort_keys)]
+  pager['unfiltered'] = query_string(query, client='', keyword='', page=1)
+  pager.update(query)
+  
+  with metrics.timer('render', feed=feed_uri, entries=len(entries)):
+    html = render_template('index.html', data=entries, pager=pager)
+    html = html.encode('utf-8')
+  
+  output = StringIO()
+  
+  with gzip.GzipFile(fileobj=output, mode='wb', compresslevel=9) as compressed:
+    compressed.write(html)
+  
+  page = {
+    'version': snapshot.get('version'),
+    'etag': hashlib.sha1(html).hexdigest(),
+    'identity': html,
+    'gzip': output.getvalue(),
+    'br': brotli.compress(html) if brotli is not None else None
+  }
+  
+  if key is not None and page['version'] is not None:
+    page_cache.set(key, page, timeout=cache_timeout + cache_stale_timeout)
+  
+  return page
+
+def query_string(query, **changes):
+  """
+  Encode feed page query arguments, leaving out defaults. Returns a string.
+  """
+  
+  query = dict(query, **changes)
+  arguments = [(k, unicode(v).encode('utf-8')) for k, v in sorted(query.items())
+               if v and (k, v) not in (('page', 1), ('sort', 'title'))]
+  
+  return '?' + urllib.urlencode(arguments)
+
+def page_response(page):
+  """
+  Serve a rendered page in the best encoding the client accepts, with a strong
+  ETag per encoding. Conditional requests for an unchanged page get a 304.
+  """
+  
+  encoding = 'identity'
+  
+  for candidate in ('br', 'gzip'):
+    if page[candidate] is not None and request.accept_encodings[candidate]:
+      encoding = candidate
+      break
+  
+  response = Response(page[encoding], mimetype='text/html')
+  response.vary.add('Accept-Encoding')
+  
+  if encoding == 'identity':
+    response.set_etag(page['etag'])
+  else:
+    response.set_etag('%s-%s' % (page['etag'], encoding))
+    response.content_encoding = encoding
+  
+  return response.make_conditional(request)
+
+@app.route('/')
+def display_feed():
+  """
+  Render the default presentation feed.
+  """
+  
+  return render_feed(uri)
+
+@app.route('/feed/<client>/<feed_id>')
+def display_client_feed(client, feed_id):
+  """
+  Render any client library's presentation feed.
+  """
+  
+  if not re.match(r'^[\w-]+$', client) or not re.match(r'^[\w-]+$', feed_id):
+    abort(404)
+  
+  return render_feed(feed_uri_format % (client, feed_id))
+
+@app.route('/thumbnails/<digest>.jpg')
+def display_thumbnail(digest):
+  """
+  Serve a resized thumbnail by content digest. The URL changes whenever the
+  content does, so responses can be cached indefinitely.
+  """
+  
+  if not re.match(r'^[0-9a-f]{40}$', digest):
+    abort(404)
+  
+  path = thumbnail_path(digest)
+  
+  # Evicted thumbnails are rebuilt from their source.
+  if not os.path.exists(path):
+    source = asset_cache.get('thumbnail-source:' + digest)
+    
+    if source is None or store_thumbnail(source) != digest:
+      abort(404)
+  
+  os.utime(path, None)
+  
+  response = send_file(path, mimetype='image/jpeg', add_etags=False,
+                       cache_timeout=365 * 24 * 60 * 60)
+  response.set_etag(digest)
+  response.cache_control.public = True
+  
+  return response.make_conditional(request)
+
+@app.route('/metrics')
+def display_metrics():
+  """
+  Report pipeline stage timings, cache hit rates and CDN traffic, in Prometheus
+  text format.
+  """
+  
+  return Response(metrics.export(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/status')
+def display_status():
+  """
+  Report the background refresher's last run, as JSON.
+  """
   
-  return render_template('index.html', data=data)
+  return jsonify(refresher.status)
 
 if __name__ == "__main__":
   app.run(host='0.0.0.0', debug=True)
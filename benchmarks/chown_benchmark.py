@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# chown_benchmark.py - Time code_samples/restful_api_service.py changing the
+#   mode of a generated directory tree, one directory per request through the
+#   chown endpoint, and in one recursive request through the batch endpoint,
+#   with a worker pool and without.
+
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                'code_samples'))
+
+import restful_api_service as service
+
+def build_tree(root, entries, fanout):
+  """
+  Create about entries files and directories under root, fanout entries per
+  directory. Returns the directories, root first.
+  """
+  
+  directories = [root]
+  created = 0
+  index = 0
+  
+  while created < entries:
+    parent = directories[index]
+    index += 1
+    
+    for number in range(fanout):
+      if created >= entries:
+        break
+      
+      path = os.path.join(parent, 'entry%d' % number)
+      
+      # One entry in ten is a directory, so the tree keeps growing.
+      if number % 10 == 0:
+        os.mkdir(path)
+        directories.append(path)
+      else:
+        open(path, 'w').close()
+      
+      created += 1
+  
+  return directories
+
+def batch(client, root, mode):
+  """
+  Recursively chmod the tree through the batch endpoint. Returns the number of
+  requests, the per-path results and the summary.
+  """
+  
+  response = client.post('/api/v1/directory/chown/batch',
+                         data=json.dumps({'paths': [root], 'mode': mode,
+                                          'recursive': True}),
+                         content_type='application/json')
+  lines = [json.loads(line) for line in response.get_data().splitlines()]
+  
+  return 1, lines[:-1], lines[-1]
+
+def single(client, directories, mode):
+  """
+  chmod every directory with one request each through the chown endpoint.
+  Returns the number of requests, the results and a summary.
+  """
+  
+  results = []
+  
+  for path in directories:
+    response = client.get('/api/v1/directory/chown',
+                          query_string={'path': path, 'mode': mode})
+    results.append(json.loads(response.get_data()))
+  
+  errors = len([result for result in results if result.get('error')])
+  
+  return len(directories), results, {'changed': len(results) - errors,
+                                     'errors': errors}
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--entries", type = "int", dest = "entries",
+                  default = 100000, help = "Files and directories to generate.")
+parser.add_option("-f", "--fanout", type = "int", dest = "fanout",
+                  default = 100, help = "Entries per directory.")
+parser.add_option("-w", "--workers", type = "int", dest = "workers",
+                  default = service.WORKERS, help = "Batch worker threads.")
+
+(options, args) = parser.parse_args()
+
+root = tempfile.mkdtemp(prefix='chown_benchmark.')
+client = service.app.test_client()
+
+try:
+  started = time.time()
+  directories = build_tree(root, options.entries, options.fanout)
+  
+  print 'Generated %d entries, %d directories, in %.1fs.' % (
+    options.entries, len(directories), time.time() - started)
+  print '%-14s %9s %9s %9s %9s %9s %12s' % (
+    'scenario', 'requests', 'paths', 'changed', 'errors', 'seconds',
+    'paths/s')
+  
+  # Every scenario but the repeat sets a new mode, so every path it covers
+  # needs changing; the repeat changes nothing.
+  for scenario, workers, mode in (
+      ('per-directory', None, '0700'),
+      ('batch serial', 1, '0750'),
+      ('batch pool', options.workers, '0755'),
+      ('batch repeat', options.workers, '0755')):
+    started = time.time()
+    
+    if workers is None:
+      requests, results, summary = single(client, directories, mode)
+    else:
+      service.WORKERS = workers
+      requests, results, summary = batch(client, root, mode)
+    
+    elapsed = time.time() - started
+    
+    print '%-14s %9d %9d %9d %9d %9.2f %12.0f' % (
+      scenario, requests, len(results), summary['changed'], summary['errors'],
+      elapsed, len(results) / elapsed)
+finally:
+  shutil.rmtree(root, ignore_errors=True)
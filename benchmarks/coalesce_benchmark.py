@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# coalesce_benchmark.py - Fire concurrent requests at app.py on a cold cache,
+#   against a local fixture CDN, from threads of one worker and from separate
+#   worker processes sharing a cache directory, and check every one of them
+#   shares a single feed rebuild: the CDN must serve the feed exactly once per
+#   scenario. Exits non-zero if it doesn't.
+
+import optparse
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fakecdn
+import load_benchmark
+
+# Cold requests without arguments stream entries as the rebuild parses them;
+# ones with arguments wait for the whole snapshot. Worker processes coalesce
+# through the rebuild lock rather than in memory.
+SCENARIOS = [('streamed', '/', 'threads'), ('waited', '/?sort=date', 'threads'),
+             ('processes', '/', 'processes')]
+
+def fire(app, path, clients):
+  """
+  GET path from clients threads at once. Returns (status, entries) per
+  response, and the wall time.
+  """
+  
+  barrier = threading.Event()
+  lock = threading.Lock()
+  responses = []
+  
+  def request():
+    client = app.app.test_client()
+    barrier.wait()
+    response = client.get(path)
+    data = response.get_data()
+    
+    with lock:
+      responses.append((response.status_code,
+                        data.count('class="media-heading"')))
+  
+  threads = [threading.Thread(target=request) for i in range(clients)]
+  
+  for thread in threads:
+    thread.start()
+  
+  started = time.time()
+  barrier.set()
+  
+  for thread in threads:
+    thread.join()
+  
+  return responses, time.time() - started
+
+def fork(directory, cdn_url, path, processes):
+  """
+  GET path once from each of processes worker processes at once, sharing one
+  cache directory. Returns (status, entries) per response, and the wall time.
+  """
+  
+  # Give every worker time to start up before the burst.
+  start = time.time() + 2
+  children = [subprocess.Popen([sys.executable, __file__, '--child', directory,
+                                cdn_url, path, repr(start)],
+                               stdout=subprocess.PIPE)
+              for i in range(processes)]
+  responses = [tuple(int(field) for field in child.communicate()[0].split())
+               for child in children]
+  
+  return responses, time.time() - start
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--entries", type = "int", dest = "entries",
+                  default = 50, help = "Fixture feed size.")
+parser.add_option("-l", "--latency", type = "float", dest = "latency",
+                  default = 0.05, help = "Added CDN latency per request, "
+                  "in seconds.")
+parser.add_option("-c", "--clients", type = "int", dest = "clients",
+                  default = 50, help = "Concurrent cold requests.")
+parser.add_option("-p", "--processes", type = "int", dest = "processes",
+                  default = 8, help = "Worker processes, one cold request "
+                  "each.")
+parser.add_option("--child", dest = "child", nargs = 4,
+                  help = "Internal: run one worker, sharing a cache directory, "
+                  "and GET a path at a given time.")
+
+(options, args) = parser.parse_args()
+
+if options.child:
+  directory, cdn_url, path, start = options.child
+  app = load_benchmark.load_isolated_app(directory, cdn=cdn_url,
+                                         uri='feed.rss')
+  time.sleep(max(float(start) - time.time(), 0))
+  (status, entries), = fire(app, path, 1)[0]
+  app.shutdown_fetch_pool()
+  
+  print status, entries
+  sys.exit()
+
+# Page size as app.py sets it, whichever scenarios run in this process.
+directory = tempfile.mkdtemp(prefix='coalesce_benchmark.')
+
+try:
+  page_size = load_benchmark.load_isolated_app(directory).page_size
+finally:
+  shutil.rmtree(directory, ignore_errors=True)
+
+cdn = fakecdn.FakeCDN(entries=options.entries, latency=options.latency).start()
+failures = []
+
+print '%-10s %8s %10s %10s %10s %10s' % (
+  'scenario', 'clients', 'seconds', 'feed reqs', 'asset reqs', 'thumb reqs')
+
+for scenario, path, workers in SCENARIOS:
+  directory = tempfile.mkdtemp(prefix='coalesce_benchmark.')
+  cdn.reset()
+  
+  try:
+    if workers == 'processes':
+      responses, elapsed = fork(directory, cdn.url, path, options.processes)
+    else:
+      app = load_benchmark.load_isolated_app(directory, cdn=cdn.url,
+                                             uri='feed.rss')
+      
+      try:
+        responses, elapsed = fire(app, path, options.clients)
+      finally:
+        app.shutdown_fetch_pool()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+  
+  print '%-10s %8d %10.2f %10d %10d %10d' % (
+    scenario, len(responses), elapsed, cdn.requests['feed'],
+    cdn.requests['asset'], cdn.requests['thumbnail'])
+  
+  if cdn.requests['feed'] != 1:
+    failures.append('%s: the CDN served the feed %d times, not once.' %
+                    (scenario, cdn.requests['feed']))
+  
+  # Streamed pages list every entry, others one page of them.
+  entries = options.entries if path == '/' else \
+            min(options.entries, page_size)
+  
+  if set(responses) != set([(200, entries)]):
+    failures.append('%s: expected every response to be a 200 listing %d '
+                    'entries, got %s.' % (scenario, entries,
+                                          sorted(set(responses))))
+
+cdn.stop()
+
+for failure in failures:
+  print 'FAIL', failure
+
+if failures:
+  sys.exit(1)
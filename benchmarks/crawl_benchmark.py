@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# crawl_benchmark.py - Run code_samples/pagerduty_crawl.py against a local fake
+#   PagerDuty API serving thousands of incidents, per service and in batch
+#   mode, from an empty store and then again over the same window, and report
+#   wall time, API requests and items fetched, and log lines written.
+
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import datetime
+
+import fakepagerduty
+
+CRAWL_PATH = os.path.join(os.path.dirname(__file__), '..', 'code_samples',
+                          'pagerduty_crawl.py')
+
+# Per service and per incident queries, and the batched --batch mode.
+MODES = [('per-service', []), ('batch', ['--batch'])]
+
+def build_crawler(directory, **constants):
+  """
+  Write a copy of pagerduty_crawl.py into directory with some of its user
+  defined constants replaced. Returns its path.
+  """
+  
+  source = open(CRAWL_PATH).read()
+  
+  for name, value in constants.items():
+    source = re.sub(r'(?ms)^%s = (\[.*?\]|[^\n]*)$' % name,
+                    '%s = %r' % (name, value), source, count=1)
+  
+  path = os.path.join(directory, 'pagerduty_crawl.py')
+  open(path, 'w').write(source)
+  
+  return path
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--incidents", type = "int", dest = "incidents",
+                  default = 2000, help = "Fixture incidents per service.")
+parser.add_option("-s", "--services", type = "int", dest = "services",
+                  default = 2, help = "Services to crawl.")
+parser.add_option("-l", "--latency", type = "float", dest = "latency",
+                  default = 0.02, help = "Added API latency per request, "
+                  "in seconds.")
+parser.add_option("-d", "--date", dest = "date", default = "06/01/2015",
+                  help = "Format: MM/DD/YYYY. First fixture incident, and "
+                  "the date crawled from.")
+
+(options, args) = parser.parse_args()
+
+# The crawler reads its since date as local time, and asks for it in UTC.
+start = datetime.strptime(options.date, '%m/%d/%Y') + \
+        (datetime.utcnow() - datetime.now())
+pagerduty = fakepagerduty.FakePagerDuty(start, incidents=options.incidents,
+                                        latency=options.latency).start()
+directory = tempfile.mkdtemp(prefix='crawl_benchmark.')
+
+try:
+  print '%-12s %-12s %9s %14s %14s %14s %9s' % (
+    'mode', 'run', 'seconds', 'incident reqs', 'entry reqs', 'entries',
+    'lines')
+  
+  for mode, flags in MODES:
+    crawler = build_crawler(directory, PAGERDUTY_URL=pagerduty.url,
+                            LOGFILE_PATH=directory,
+                            STORE_PATH=os.path.join(directory, mode + '.db'),
+                            SERVICES=['PBENCH%02d' % i
+                                      for i in range(options.services)])
+    
+    for run in ('cold', 'incremental'):
+      pagerduty.reset()
+      started = time.time()
+      subprocess.check_call([sys.executable, crawler, '-d', options.date] +
+                            flags, stdout=open(os.devnull, 'w'))
+      elapsed = time.time() - started
+      lines = len(open(os.path.join(directory,
+                                    'pagerduty.dump')).readlines())
+      
+      print '%-12s %-12s %9.2f %14d %14d %14d %9d' % (
+        mode, run, elapsed, pagerduty.requests['incidents'],
+        pagerduty.requests['log_entries'], pagerduty.items['log_entries'],
+        lines)
+finally:
+  pagerduty.stop()
+  shutil.rmtree(directory, ignore_errors=True)
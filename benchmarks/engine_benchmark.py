@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# engine_benchmark.py - Compare wall time and peak RSS of app.py's feed
+#   pipeline engines on a cold asset cache, against a local fixture CDN.
+
+import json
+import optparse
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakecdn
+import load_benchmark
+
+# (label, fetch engine, fetch pool mode), baseline first.
+ENGINES = [
+  ('pool/process', 'pool', 'process'),
+  ('pool/thread', 'pool', 'thread'),
+  ('pipeline', 'pipeline', 'thread')
+]
+
+def run_engine(cdn_url, engine, mode):
+  """
+  Build the feed once with the given engine, in this process, on fresh
+  in-memory caches. Returns wall time, entry count and peak RSS in KB.
+  """
+  
+  directory = tempfile.mkdtemp(prefix='engine_benchmark.')
+  app = load_benchmark.load_isolated_app(directory, cdn=cdn_url,
+                                         uri='feed.rss', cache_backend='simple',
+                                         fetch_engine=engine, fetch_mode=mode)
+  
+  try:
+    started = time.time()
+    entries = app.parse_rss_feed(cdn_url + app.uri)
+    elapsed = time.time() - started
+  finally:
+    app.shutdown_fetch_pool()
+    shutil.rmtree(directory, ignore_errors=True)
+  
+  # Process pools keep their own memory; count the largest joined worker too.
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  
+  return {'seconds': elapsed, 'entries': len(entries), 'rss': rss}
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--entries", type = "int", dest = "entries",
+                  default = 100, help = "Fixture feed size.")
+parser.add_option("-l", "--latency", type = "float", dest = "latency",
+                  default = 0.02, help = "Added CDN latency per request, "
+                  "in seconds.")
+parser.add_option("--child", dest = "child", nargs = 3,
+                  help = "Internal: run one engine against a CDN URL.")
+
+(options, args) = parser.parse_args()
+
+if options.child:
+  cdn_url, engine, mode = options.child
+  print json.dumps(run_engine(cdn_url, engine, mode))
+  sys.exit()
+
+cdn = fakecdn.FakeCDN(entries=options.entries, latency=options.latency).start()
+
+print '%-14s %10s %12s %10s %14s' % ('engine', 'seconds', 'peak RSS', 'requests',
+                                     'asset bytes')
+
+# Each engine runs in a fresh interpreter, so peak RSS isn't shared.
+for label, engine, mode in ENGINES:
+  cdn.reset()
+  output = subprocess.check_output([sys.executable, __file__, '--child',
+                                    cdn.url, engine, mode])
+  result = json.loads(output.strip().splitlines()[-1])
+  
+  print '%-14s %10.2f %9d KB %10d %14d' % (
+    label, result['seconds'], result['rss'],
+    sum(cdn.requests.values()), cdn.bytes['asset'])
+
+cdn.stop()
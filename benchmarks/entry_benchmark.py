@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+# entry_benchmark.py - Compare per-entry memory and pickled size of cached feed
+#   entries as slotted VideoEntry objects, against the FeedParserDict entries
+#   the cache used to hold.
+
+import cPickle
+import optparse
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from humanize import naturalsize
+
+import fakecdn
+import feedparser
+import load_benchmark
+
+def legacy_entry(entry, video):
+  """
+  Decorate a raw feed entry the way format_entry used to, with the display
+  values of an already parsed VideoEntry. Returns the FeedParserDict.
+  """
+  
+  minutes, seconds = divmod(int(video.duration), 60)
+  date = time.strftime('%l:%M%p on %A, %B %d, %Y', entry['published_parsed'])
+  
+  entry['codec'] = video.codec
+  entry['duration'] = '%sm %ss' % (minutes, seconds)
+  entry['seconds'] = int(video.duration)
+  entry['bitrate'] = '{0:,} kb/s'.format(int(video.bitrate / 1024))
+  entry['thumbnail'] = video.thumbnail
+  entry['thumbnail_digest'] = video.thumbnail_digest
+  entry['client'] = video.client
+  entry['credits'] = sorted(entry['media_credit'], key=lambda k: k['role'])
+  entry['date'] = date.replace('AM', 'am').replace('PM', 'pm')
+  entry['size'] = naturalsize(entry['media_content'][0]['filesize'])
+  
+  return entry
+
+def deep_size(value, seen=None):
+  """
+  Total sys.getsizeof of an object graph, counting shared objects once.
+  """
+  
+  seen = set() if seen is None else seen
+  
+  if id(value) in seen:
+    return 0
+  
+  seen.add(id(value))
+  size = sys.getsizeof(value)
+  
+  if isinstance(value, dict):
+    size += sum(deep_size(k, seen) + deep_size(v, seen)
+                for k, v in value.items())
+  elif isinstance(value, (list, tuple, set, frozenset)):
+    size += sum(deep_size(v, seen) for v in value)
+  elif hasattr(value, '__slots__'):
+    size += sum(deep_size(getattr(value, name), seen)
+                for name in value.__slots__ if hasattr(value, name))
+  elif hasattr(value, '__dict__'):
+    size += deep_size(value.__dict__, seen)
+  
+  return size
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--entries", type = "int", dest = "entries",
+                  default = 100, help = "Fixture feed size.")
+parser.add_option("-r", "--repeat", type = "int", dest = "repeat",
+                  default = 20, help = "Pickling runs; the best is reported.")
+
+(options, args) = parser.parse_args()
+
+cdn = fakecdn.FakeCDN(entries=options.entries, latency=0).start()
+directory = tempfile.mkdtemp(prefix='entry_benchmark.')
+app = load_benchmark.load_isolated_app(directory, cdn=cdn.url, uri='feed.rss',
+                                       cache_backend='simple')
+
+try:
+  entries = app.parse_rss_feed(cdn.url + app.uri)
+  videos = dict((e.id, e) for e in entries)
+  legacy = [legacy_entry(e, videos[app.entry_id(e)])
+            for e in feedparser.parse(cdn.url + app.uri)['entries']]
+finally:
+  app.shutdown_fetch_pool()
+  shutil.rmtree(directory, ignore_errors=True)
+  cdn.stop()
+
+print '%-14s %14s %14s %12s %12s' % ('model', 'memory/entry',
+                                     'pickle/entry', 'dumps', 'loads')
+
+for label, data in (('FeedParserDict', legacy), ('VideoEntry', entries)):
+  pickled = cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+  dumps = min(timeit.Timer(lambda: cPickle.dumps(
+    data, cPickle.HIGHEST_PROTOCOL)).repeat(options.repeat, 1))
+  loads = min(timeit.Timer(lambda: cPickle.loads(pickled)).repeat(
+    options.repeat, 1))
+  
+  print '%-14s %11d B %11d B %10.2fms %10.2fms' % (
+    label, deep_size(data) / len(data), len(pickled) / len(data),
+    dumps * 1e3, loads * 1e3)
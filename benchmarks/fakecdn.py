@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# fakecdn.py - Local stand-in for the Wiredrive CDN. Serves a synthetic
+#   presentation feed, fixture assets with HTTP Range support and thumbnails,
+#   with optional added latency, and counts what it served.
+
+import BaseHTTPServer
+import re
+import threading
+import time
+
+from cStringIO import StringIO
+from PIL import Image
+from SocketServer import ThreadingMixIn
+
+import fixtures
+
+def build_thumbnail(width=640, height=360):
+  """
+  Encode a flat colour JPEG of the given size. Returns a string.
+  """
+  
+  output = StringIO()
+  Image.new('RGB', (width, height), (40, 90, 140)).save(output, 'JPEG')
+  return output.getvalue()
+
+THUMBNAIL = build_thumbnail()
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class FakeCDN(object):
+  """
+  Fixture HTTP server, run on a background thread. Feed size and per-request
+  latency are configurable; requests and bytes served are tallied by path type.
+  """
+  
+  def __init__(self, entries=100, latency=0.0, port=0):
+    self.entries = entries
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.reset()
+    
+    self.server = ThreadedHTTPServer(('127.0.0.1', port), handler(self))
+    self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+    self.feed = fixtures.build_feed(self.url, entries)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+  
+  def start(self):
+    self.thread.start()
+    return self
+  
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+  
+  def reset(self):
+    with self.lock:
+      self.requests = {'feed': 0, 'asset': 0, 'thumbnail': 0}
+      self.bytes = {'feed': 0, 'asset': 0, 'thumbnail': 0}
+  
+  def tally(self, kind, size):
+    with self.lock:
+      self.requests[kind] += 1
+      self.bytes[kind] += size
+
+def handler(cdn):
+  """
+  Build a request handler class bound to a FakeCDN instance.
+  """
+  
+  class FakeCDNHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def do_HEAD(self):
+      self.do_GET(body=False)
+    
+    def do_GET(self, body=True):
+      if cdn.latency:
+        time.sleep(cdn.latency)
+      
+      asset = re.match(r'^/assets/(\d+)\.mov$', self.path)
+      thumbnail = re.match(r'^/thumbnails/(\d+)-\w+\.jpg$', self.path)
+      
+      if self.path.startswith(('/feed', '/rss/')):
+        kind, data, content_type = 'feed', cdn.feed, 'application/rss+xml'
+      elif asset:
+        kind, content_type = 'asset', 'video/quicktime'
+        data = fixtures.asset(int(asset.group(1)))
+      elif thumbnail:
+        kind, data, content_type = 'thumbnail', THUMBNAIL, 'image/jpeg'
+      else:
+        self.send_error(404)
+        return
+      
+      etag = '"%s-%d"' % (kind, len(data))
+      
+      if self.headers.get('If-None-Match') == etag:
+        cdn.tally(kind, 0)
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      
+      status, start, end = 200, 0, len(data) - 1
+      byte_range = re.match(r'^bytes=(\d*)-(\d*)$',
+                            self.headers.get('Range', ''))
+      
+      if byte_range:
+        first, last = byte_range.groups()
+        
+        if first:
+          start, end = int(first), min(int(last or end), end)
+        else:
+          start = max(len(data) - int(last), 0)
+        
+        status = 206
+      
+      chunk = data[start:end + 1]
+      cdn.tally(kind, len(chunk) if body else 0)
+      
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(chunk)))
+      self.send_header('ETag', etag)
+      self.send_header('Accept-Ranges', 'bytes')
+      
+      if status == 206:
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (start, end, len(data)))
+      
+      self.end_headers()
+      
+      if body:
+        self.wfile.write(chunk)
+    
+    def log_message(self, *args):
+      pass
+  
+  return FakeCDNHandler
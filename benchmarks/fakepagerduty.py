@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#
+# fakepagerduty.py - Local stand-in for the PagerDuty v1 REST API. Serves
+#   synthetic incidents and log entries for any service ID, per service,
+#   per incident and account-wide, paginated and filtered the way PagerDuty
+#   does, with optional added latency, and counts what it served.
+
+import _strptime   # Imported lazily by strptime, which isn't thread safe.
+import BaseHTTPServer
+import bisect
+import json
+import re
+import threading
+import time
+import urlparse
+
+from datetime import datetime
+from datetime import timedelta
+from SocketServer import ThreadingMixIn
+
+# PagerDuty caps every page at 100 items, whatever limit is asked for.
+MAX_LIMIT = 100
+
+# Log entry types the API returns with is_overview=true.
+OVERVIEW_TYPES = ('trigger', 'assign', 'acknowledge', 'resolve')
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+def api_time(value):
+  return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def parse_time(value):
+  """
+  Parse a since or until parameter, as PagerDuty accepts them with or without
+  seconds. Returns the canonical API time string.
+  """
+  
+  value = value.rstrip('Z')
+  
+  for pattern in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'):
+    try:
+      return api_time(datetime.strptime(value, pattern))
+    except ValueError:
+      pass
+  
+  raise ValueError('Bad time "%s".' % value)
+
+class FakePagerDuty(object):
+  """
+  Fixture HTTP server, run on a background thread. Each service gets incidents
+  incidents spread evenly over the days after start; every third is left
+  acknowledged, the rest resolved. The account holds every service asked for
+  so far. Requests are tallied by endpoint.
+  """
+  
+  def __init__(self, start, incidents=1000, days=30, latency=0.0, port=0):
+    self.start_time = start
+    self.incidents = incidents
+    self.spacing = timedelta(days=days) / max(incidents, 1)
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.services = {}
+    self.log_entries = {}
+    self.listings = {}
+    self.reset()
+    
+    self.server = ThreadedHTTPServer(('127.0.0.1', port), handler(self))
+    self.url = 'http://127.0.0.1:%d' % self.server.server_port
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+  
+  def start(self):
+    self.thread.start()
+    return self
+  
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+  
+  def reset(self):
+    with self.lock:
+      self.requests = {'incidents': 0, 'log_entries': 0}
+      self.items = {'incidents': 0, 'log_entries': 0}
+  
+  def tally(self, kind, count):
+    with self.lock:
+      self.requests[kind] += 1
+      self.items[kind] += count
+  
+  def service(self, service_id):
+    """
+    Build, once, the incidents of a service and their log entries. Returns the
+    incidents, oldest first.
+    """
+    
+    with self.lock:
+      if service_id not in self.services:
+        self.services[service_id] = [self.build_incident(service_id, number)
+                                     for number in range(self.incidents)]
+        
+        # The account has grown; account-wide listings are stale.
+        self.listings = {}
+      
+      return self.services[service_id]
+  
+  def build_incident(self, service_id, number):
+    incident_id = '%s-%d' % (service_id, number)
+    created = self.start_time + self.spacing * number
+    resolved = number % 3 != 0
+    entries = []
+    
+    for minute, kind in enumerate(('trigger', 'notify', 'assign', 'notify',
+                                   'acknowledge', 'resolve')):
+      if kind == 'resolve' and not resolved:
+        break
+      
+      entries.append({
+        'id': '%s-%d' % (incident_id, minute),
+        'type': kind,
+        'created_at': api_time(created + timedelta(minutes=minute)),
+        'agent': {'type': 'user', 'name': 'Agent %d' % (number % 7)},
+        'assigned_user': {'name': 'User %d' % (number % 5)},
+        'channel': {'type': 'email', 'summary': 'Alert %d' % number},
+        'incident': {'id': incident_id}
+      })
+    
+    self.log_entries[incident_id] = entries
+    
+    return {
+      'id': incident_id,
+      'incident_number': number,
+      'incident_key': 'key %d' % number,
+      'created_on': api_time(created),
+      'status': resolved and 'resolved' or 'acknowledged',
+      'html_url': 'https://example.pagerduty.com/incidents/%d' % number,
+      'service': {'id': service_id, 'name': 'Service %s' % service_id},
+      'trigger_summary_data': {'subject': 'Alert %d' % number}
+    }
+  
+  def listing(self, kind, key):
+    """
+    Build, once, a time ordered listing: the incidents of a comma separated
+    list of services, the log entries of an incident, or every log entry in
+    the account (key None). Returns (times, items).
+    """
+    
+    if kind == 'incidents':
+      for service_id in key.split(','):
+        self.service(service_id)
+    elif key is not None:
+      self.service(key.rsplit('-', 1)[0])
+    
+    with self.lock:
+      if (kind, key) not in self.listings:
+        if kind == 'incidents':
+          field = 'created_on'
+          items = [incident for service_id in key.split(',')
+                   for incident in self.services[service_id]]
+        elif key is not None:
+          field = 'created_at'
+          items = self.log_entries[key]
+        else:
+          field = 'created_at'
+          items = [entry for entries in self.log_entries.values()
+                   for entry in entries]
+        
+        items = sorted(items, key=lambda item: (item[field], item['id']))
+        self.listings[kind, key] = ([item[field] for item in items], items)
+      
+      return self.listings[kind, key]
+
+def window(listing, since, until):
+  """
+  Cut the items between since and until, inclusive, out of a time ordered
+  listing. Returns a list.
+  """
+  
+  times, items = listing
+  
+  return items[bisect.bisect_left(times, since):
+               bisect.bisect_right(times, until)]
+
+def page(items, query, key):
+  """
+  Cut one page out of items by the offset and limit in query. Returns the
+  response body, with the total PagerDuty reports alongside it.
+  """
+  
+  offset = int(query.get('offset', 0))
+  limit = min(int(query.get('limit', MAX_LIMIT)), MAX_LIMIT)
+  
+  return {key: items[offset:offset + limit], 'total': len(items),
+          'offset': offset, 'limit': limit}
+
+def handler(pagerduty):
+  """
+  Build a request handler class bound to a FakePagerDuty instance.
+  """
+  
+  class FakePagerDutyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    # Headers and body go out in separate writes; don't hold the body back
+    # waiting on the client's delayed ACK.
+    disable_nagle_algorithm = True
+    
+    def do_GET(self):
+      if pagerduty.latency:
+        time.sleep(pagerduty.latency)
+      
+      url = urlparse.urlparse(self.path)
+      query = dict(urlparse.parse_qsl(url.query))
+      since = parse_time(query.get('since', '1970-01-01T00:00'))
+      until = parse_time(query.get('until', '2100-01-01T00:00'))
+      incident_entries = re.match(r'^/api/v1/incidents/([\w-]+)/log_entries$',
+                                  url.path)
+      
+      if url.path == '/api/v1/incidents':
+        kind = 'incidents'
+        items = window(pagerduty.listing(kind, query['service']), since, until)
+      elif url.path == '/api/v1/log_entries' or incident_entries:
+        kind = 'log_entries'
+        items = window(pagerduty.listing(kind, incident_entries and
+                                         incident_entries.group(1)),
+                       since, until)
+        
+        if query.get('is_overview') == 'true':
+          items = [entry for entry in items if entry['type'] in OVERVIEW_TYPES]
+      else:
+        self.send_error(404)
+        return
+      
+      body = page(items, query, kind)
+      fields = query.get('fields')
+      
+      if fields:
+        body[kind] = [dict((name, item[name])
+                           for name in fields.split(',') if name in item)
+                      for item in body[kind]]
+      
+      # Log entries only carry their incident when asked to.
+      if kind == 'log_entries' and query.get('include[]') != 'incident':
+        body[kind] = [dict((name, value) for name, value in entry.items()
+                           if name != 'incident') for entry in body[kind]]
+      
+      data = json.dumps(body)
+      pagerduty.tally(kind, len(body[kind]))
+      
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+    
+    def log_message(self, *args):
+      pass
+  
+  return FakePagerDutyHandler
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# fixtures.py - Synthetic QuickTime/MP4 assets for benchmarking app.py without
+#   hitting the CDN.
+
+import struct
+
+def atom(kind, *children):
+  """
+  Serialize an atom from its type and already serialized body parts.
+  """
+  
+  body = ''.join(children)
+  return struct.pack('>I4s', len(body) + 8, kind) + body
+
+def full_atom(kind, version, flags, *children):
+  return atom(kind, struct.pack('>I', (version << 24) | flags), *children)
+
+def build_mp4(duration=30, timescale=600, fps=24, sample_size=2048,
+              width=640, height=360, encoder='Photo - JPEG',
+              moov_at_end=False):
+  """
+  Build a small but structurally complete single video track QuickTime file.
+  Frames are filler bytes, so it demuxes but doesn't decode. Returns a string.
+  """
+  
+  count = duration * fps
+  delta = timescale / fps
+  ftyp = atom('ftyp', 'qt  ', struct.pack('>I', 0x200), 'qt  ')
+  mdat = atom('mdat', '\x00' * (sample_size * count))
+  
+  def moov(mdat_offset):
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    
+    mvhd = full_atom('mvhd', 0, 0,
+                     struct.pack('>IIII', 0, 0, timescale, duration * timescale),
+                     struct.pack('>IH', 0x10000, 0x100), '\x00' * 10, matrix,
+                     '\x00' * 24, struct.pack('>I', 2))
+    tkhd = full_atom('tkhd', 0, 3,
+                     struct.pack('>IIIII', 0, 0, 1, 0, duration * timescale),
+                     '\x00' * 8, struct.pack('>HHHH', 0, 0, 0, 0), matrix,
+                     struct.pack('>II', width << 16, height << 16))
+    mdhd = full_atom('mdhd', 0, 0,
+                     struct.pack('>IIII', 0, 0, timescale, duration * timescale),
+                     struct.pack('>HH', 0, 0))
+    hdlr = full_atom('hdlr', 0, 0, 'mhlr', 'vide', '\x00' * 12, '\x00')
+    
+    name = encoder[:31]
+    sample_entry = atom('jpeg', '\x00' * 6, struct.pack('>H', 1),
+                        struct.pack('>HH4sII', 0, 0, 'appl', 0, 512),
+                        struct.pack('>HHIIIH', width, height, 0x480000,
+                                    0x480000, 0, 1),
+                        chr(len(name)) + name + '\x00' * (31 - len(name)),
+                        struct.pack('>hh', 24, -1))
+    stsd = full_atom('stsd', 0, 0, struct.pack('>I', 1), sample_entry)
+    stts = full_atom('stts', 0, 0, struct.pack('>III', 1, count, delta))
+    stsc = full_atom('stsc', 0, 0, struct.pack('>IIII', 1, 1, count, 1))
+    stsz = full_atom('stsz', 0, 0, struct.pack('>II', 0, count),
+                     struct.pack('>%dI' % count, *([sample_size] * count)))
+    stco = full_atom('stco', 0, 0, struct.pack('>II', 1, mdat_offset))
+    
+    vmhd = full_atom('vmhd', 0, 1, '\x00' * 8)
+    dref = full_atom('dref', 0, 0, struct.pack('>I', 1),
+                     full_atom('url ', 0, 1))
+    minf = atom('minf', vmhd, atom('dinf', dref),
+                atom('stbl', stsd, stts, stsc, stsz, stco))
+    trak = atom('trak', tkhd, atom('mdia', mdhd, hdlr, minf))
+    
+    return atom('moov', mvhd, trak)
+  
+  # Chunk offsets point past the mdat header, so size moov before placing it.
+  if moov_at_end:
+    return ftyp + mdat + moov(len(ftyp) + 8)
+  
+  header = len(ftyp) + len(moov(0))
+  return ftyp + moov(header + 8) + mdat
+
+def build_feed(base_url, count):
+  """
+  Build a Media RSS presentation feed of count entries, each pointing at a
+  fixture asset and thumbnail under base_url. Returns a string.
+  """
+  
+  items = []
+  
+  for index in range(count):
+    items.append(ITEM_TEMPLATE % {
+      'index': index,
+      'base_url': base_url,
+      'client': CLIENTS[index % len(CLIENTS)],
+      'day': index % 28 + 1,
+      'size': len(asset(index)),
+      'keywords': ','.join(KEYWORDS[index % len(KEYWORDS):][:3])
+    })
+  
+  return FEED_TEMPLATE % {'base_url': base_url, 'items': ''.join(items)}
+
+def asset(index):
+  """
+  Return the fixture asset for a feed entry. Assets cycle through a few
+  lengths and both moov layouts, and are built once.
+  """
+  
+  key = index % len(ASSET_VARIANTS)
+  
+  if key not in assets:
+    duration, moov_at_end = ASSET_VARIANTS[key]
+    assets[key] = build_mp4(duration=duration, moov_at_end=moov_at_end)
+  
+  return assets[key]
+
+ASSET_VARIANTS = [(30, False), (60, False), (90, True), (45, True)]
+CLIENTS = ['Iowa', 'Acme', 'Globex', 'Initech']
+KEYWORDS = ['spot', 'broadcast', 'web', 'cutdown', 'director', 'final', 'teaser']
+
+# Built assets, by variant.
+assets = {}
+
+FEED_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:media="http://search.yahoo.com/mrss/">
+  <channel>
+    <title>Fixture Presentation</title>
+    <link>%(base_url)s</link>
+    <description>Synthetic feed for benchmarking.</description>
+%(items)s  </channel>
+</rss>
+"""
+
+ITEM_TEMPLATE = """    <item>
+      <title>Fixture Spot %(index)05d</title>
+      <link>%(base_url)spresentation/%(index)d</link>
+      <guid isPermaLink="false">fixture-%(index)d</guid>
+      <description>spot_%(index)05d.mov</description>
+      <pubDate>Mon, %(day)02d Jun 2015 17:32:37 GMT</pubDate>
+      <media:content url="%(base_url)sassets/%(index)d.mov" fileSize="%(size)d" type="video/quicktime" width="640" height="360" />
+      <media:thumbnail url="%(base_url)sthumbnails/%(index)d-large.jpg" width="640" height="360" />
+      <media:thumbnail url="%(base_url)sthumbnails/%(index)d-small.jpg" width="160" height="90" />
+      <media:credit role="client">%(client)s</media:credit>
+      <media:credit role="director">Jane Doe</media:credit>
+      <media:credit role="agency">Fixture Agency</media:credit>
+      <media:keywords>%(keywords)s</media:keywords>
+    </item>
+"""
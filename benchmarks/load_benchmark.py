@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# load_benchmark.py - Load test app.py against a local fixture CDN. Runs the
+#   cold cache, warm cache, concurrent burst and cache expiry scenarios, and
+#   reports latency percentiles, throughput, CDN traffic and peak RSS.
+
+import imp
+import json
+import optparse
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fakecdn
+
+APP_PATH = os.path.join(os.path.dirname(__file__), '..', 'app.py')
+
+SCENARIOS = ['parse', 'cold', 'warm', 'burst', 'expiry']
+
+def load_app(**constants):
+  """
+  Import app.py with some of its user defined constants replaced, before any of
+  its startup code (caches, pools, the refresher) runs. Returns the module.
+  """
+  
+  source = open(APP_PATH).read()
+  
+  for name, value in constants.items():
+    source = re.sub(r'(?m)^%s = .*$' % name, '%s = %r' % (name, value), source,
+                    count=1)
+  
+  module = imp.new_module('app')
+  module.__file__ = APP_PATH
+  sys.modules['app'] = module
+  exec compile(source, APP_PATH, 'exec') in module.__dict__
+  
+  return module
+
+def load_isolated_app(directory, **constants):
+  """
+  Load app.py with its caches, thumbnails and snapshots under directory and
+  the background refresher off, so nothing it does reaches shared directories
+  or the live CDN feed. Other constants, cdn and uri among them, as load_app.
+  """
+  
+  settings = {'cache_dir': directory,
+              'thumbnail_dir': os.path.join(directory, 'thumbnails'),
+              'snapshot_dir': os.path.join(directory, 'snapshots'),
+              'refresh_in_background': False}
+  settings.update(constants)
+  
+  return load_app(**settings)
+
+def percentile(samples, percent):
+  """
+  Nearest-rank percentile of a list of samples.
+  """
+  
+  ordered = sorted(samples)
+  
+  return ordered[max(int(round(percent / 100.0 * len(ordered))) - 1, 0)]
+
+def timed_get(client, path):
+  started = time.time()
+  response = client.get(path)
+  response.get_data()
+  
+  if response.status_code != 200:
+    raise IOError('GET %s: HTTP %s' % (path, response.status_code))
+  
+  return time.time() - started
+
+def run_scenario(scenario, cdn_url, rounds, concurrency):
+  """
+  Run one scenario in this process, against fresh cache and snapshot
+  directories. Returns per-request latencies, wall time and peak RSS in KB.
+  """
+  
+  directory = tempfile.mkdtemp(prefix='load_benchmark.')
+  
+  # The refresher is off, so every rebuild measured is one a request caused.
+  app = load_isolated_app(directory, cdn=cdn_url, uri='feed.rss')
+  client = app.app.test_client()
+  latencies = []
+  
+  def clear():
+    app.cache.clear()
+    app.asset_cache.clear()
+    app.page_cache.clear()
+    
+    for name in os.listdir(app.snapshot_dir):
+      os.remove(os.path.join(app.snapshot_dir, name))
+  
+  try:
+    started = time.time()
+    
+    if scenario == 'parse':
+      for index in range(rounds):
+        clear()
+        request_started = time.time()
+        app.parse_rss_feed(cdn_url + app.uri)
+        latencies.append(time.time() - request_started)
+    elif scenario == 'cold':
+      for index in range(rounds):
+        clear()
+        latencies.append(timed_get(client, '/'))
+    elif scenario == 'warm':
+      timed_get(client, '/')
+      started = time.time()
+      
+      for index in range(rounds):
+        latencies.append(timed_get(client, '/'))
+    elif scenario == 'burst':
+      # Every client starts at once, against a cold cache.
+      barrier = threading.Event()
+      lock = threading.Lock()
+      
+      def burst():
+        local = app.app.test_client()
+        barrier.wait()
+        
+        for index in range(rounds):
+          latency = timed_get(local, '/')
+          
+          with lock:
+            latencies.append(latency)
+      
+      threads = [threading.Thread(target=burst) for i in range(concurrency)]
+      
+      for thread in threads:
+        thread.start()
+      
+      started = time.time()
+      barrier.set()
+      
+      for thread in threads:
+        thread.join()
+    elif scenario == 'expiry':
+      # Each round expires the snapshot, serves it stale while a rebuild
+      # revalidates the feed, then waits the rebuild out.
+      timed_get(client, '/')
+      started = time.time()
+      
+      for index in range(rounds):
+        snapshot = app.cached_snapshot(app.uri)
+        snapshot['expires'] = 0
+        app.cache_snapshot_header(app.uri, snapshot)
+        latencies.append(timed_get(client, '/'))
+        
+        # Until the rebuild has left the flight, and so released its lock,
+        # another stale request would only join it.
+        while app.cached_snapshot(app.uri)['expires'] == 0 or \
+              app.flight.calls:
+          time.sleep(0.01)
+    else:
+      raise ValueError('Unrecognized scenario "%s".' % scenario)
+    
+    elapsed = time.time() - started
+  finally:
+    app.shutdown_fetch_pool()
+    shutil.rmtree(directory, ignore_errors=True)
+  
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  
+  return {'latencies': latencies, 'seconds': elapsed, 'rss': rss}
+
+if __name__ == '__main__':
+  parser = optparse.OptionParser()
+  parser.add_option("-n", "--entries", type = "int", dest = "entries",
+                    default = 100, help = "Fixture feed size.")
+  parser.add_option("-l", "--latency", type = "float", dest = "latency",
+                    default = 0.02, help = "Added CDN latency per request, "
+                    "in seconds.")
+  parser.add_option("-r", "--rounds", type = "int", dest = "rounds",
+                    default = 20, help = "Requests per scenario, or per client "
+                    "in a burst.")
+  parser.add_option("-c", "--concurrency", type = "int", dest = "concurrency",
+                    default = 10, help = "Concurrent clients in a burst.")
+  parser.add_option("-s", "--scenario", action = "append", dest = "scenarios",
+                    choices = SCENARIOS, help = "Scenario to run; repeatable. "
+                    "Defaults to all of %s." % ', '.join(SCENARIOS))
+  parser.add_option("--child", dest = "child", nargs = 2,
+                    help = "Internal: run one scenario against a CDN URL.")
+  
+  (options, args) = parser.parse_args()
+  
+  if options.child:
+    scenario, cdn_url = options.child
+    print json.dumps(run_scenario(scenario, cdn_url, options.rounds,
+                                  options.concurrency))
+    sys.exit()
+  
+  cdn = fakecdn.FakeCDN(entries=options.entries,
+                        latency=options.latency).start()
+  
+  print '%-8s %6s %9s %9s %9s %9s %11s %9s %12s' % (
+    'scenario', 'reqs', 'p50', 'p95', 'p99', 'req/s', 'CDN reqs', 'CDN KB',
+    'peak RSS')
+  
+  # Each scenario runs in a fresh interpreter, so caches and peak RSS aren't
+  # shared.
+  for scenario in options.scenarios or SCENARIOS:
+    cdn.reset()
+    output = subprocess.check_output([
+      sys.executable, __file__, '--child', scenario, cdn.url,
+      '--rounds', str(options.rounds),
+      '--concurrency', str(options.concurrency)])
+    result = json.loads(output.strip().splitlines()[-1])
+    latencies = result['latencies']
+    
+    print '%-8s %6d %7.1fms %7.1fms %7.1fms %9.1f %11d %9d %9d KB' % (
+      scenario, len(latencies), percentile(latencies, 50) * 1e3,
+      percentile(latencies, 95) * 1e3, percentile(latencies, 99) * 1e3,
+      len(latencies) / result['seconds'], sum(cdn.requests.values()),
+      sum(cdn.bytes.values()) / 1024, result['rss'])
+  
+  cdn.stop()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# probe_benchmark.py - Compare per-asset header probe time of the native
+#   mp4atoms reader against PyAV's av.open, on synthetic in-memory assets.
+
+import optparse
+import os
+import sys
+import timeit
+
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import av
+import fixtures
+import mp4atoms
+
+def probe_native(data):
+  return mp4atoms.probe(StringIO(data))
+
+def probe_pyav(data):
+  container = av.open(StringIO(data))
+  stream = next(s for s in container.streams if s.type == 'video')
+  return stream.metadata['encoder'], stream.duration, stream.bit_rate
+
+parser = optparse.OptionParser()
+parser.add_option("-n", "--number", type = "int", dest = "number",
+                  default = 200, help = "Probes per timing run.")
+parser.add_option("-r", "--repeat", type = "int", dest = "repeat",
+                  default = 5, help = "Timing runs; the best is reported.")
+parser.add_option("-d", "--duration", type = "int", dest = "duration",
+                  default = 120, help = "Fixture length in seconds.")
+
+(options, args) = parser.parse_args()
+
+print '%-14s %-8s %12s %12s %8s' % ('layout', 'moov', 'mp4atoms', 'av.open',
+                                    'speedup')
+
+for moov_at_end in (False, True):
+  data = fixtures.build_mp4(duration=options.duration, moov_at_end=moov_at_end)
+  results = []
+  
+  for function in (probe_native, probe_pyav):
+    timer = timeit.Timer(lambda: function(data))
+    best = min(timer.repeat(options.repeat, options.number))
+    results.append(best / options.number * 1e6)
+  
+  print '%-14s %-8s %10.1fus %10.1fus %7.1fx' % (
+    '%d KB' % (len(data) / 1024), 'end' if moov_at_end else 'start',
+    results[0], results[1], results[1] / results[0])
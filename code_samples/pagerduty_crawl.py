@@ -2,12 +2,14 @@
 #
 # PagerDuty_Crawl.py - Crawls PagerDuty API for alerts, and displays them in
 #   both parsable and human-readable formats. Written for backwards
-#   compatibility with Python 2.4, hence optparse.
+#   compatibility with Python 2.4, hence optparse (and pysqlite2, where the
+#   sqlite3 module is missing).
 
 ################################################################################
 # User defined constants.
 
 LOGFILE_PATH = '/tmp/pd_crawl.log'     # Location to dump temporary log files.
+STORE_PATH = '/tmp/pd_crawl.db'        # Local incident store, kept between runs.
 PAGERDUTY_URL = 'https://pagerduty.com'  # Register at PagerDuty.com.
 API_TOKEN = '<API_TOKEN_GOES_HERE>'     # Generate online, /api_keys.
 
@@ -17,14 +19,359 @@ SERVICES = [
   'P52N86V'  # Pingdom Service
 ]
 
+WORKERS = 8         # Concurrent API requests, and kept-alive connections.
+MAX_RETRIES = 5     # Attempts to wait out a rate limit (HTTP 429) per request.
+TIMEOUT = 30        # Seconds to wait on each API response.
+OUTPUT_BATCH = 1000 # Log lines buffered per write.
+PAGE_SIZE = 100     # Items per API page; PagerDuty's maximum.
+STORE_BATCH = 50    # Pages stored per commit.
+
 ################################################################################
 # Script begins.
 
 import sys
+import time
+import heapq
+import Queue
 import optparse
+import threading
 import requests           # Requires Requests (python-requests.org).
 from   datetime import datetime
 from   datetime import timedelta
+from   requests.adapters import HTTPAdapter
+
+try:
+  import sqlite3
+except ImportError:
+  from pysqlite2 import dbapi2 as sqlite3
+
+# Local store of crawled incidents and log entries. Checkpoints record, per
+# service, the window already crawled, so overlapping runs only fetch what's
+# new since.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS incidents (
+  id TEXT PRIMARY KEY,
+  service TEXT,
+  service_name TEXT,
+  incident_number INTEGER,
+  incident_key TEXT,
+  status TEXT,
+  created_on TEXT
+);
+CREATE INDEX IF NOT EXISTS incidents_service
+  ON incidents (service, created_on);
+CREATE TABLE IF NOT EXISTS log_entries (
+  id TEXT PRIMARY KEY,
+  incident TEXT,
+  type TEXT,
+  created_at TEXT,
+  agent TEXT,
+  assigned_user TEXT
+);
+CREATE INDEX IF NOT EXISTS log_entries_incident
+  ON log_entries (incident, created_at);
+CREATE TABLE IF NOT EXISTS checkpoints (
+  service TEXT PRIMARY KEY,
+  since TEXT,
+  until TEXT
+);
+"""
+
+# Shared HTTP session. Keeps connections to PagerDuty alive between requests,
+# and sends the API token with each of them.
+session = requests.Session()
+session.headers['Authorization'] = 'Token token=' + API_TOKEN
+session.mount(PAGERDUTY_URL, HTTPAdapter(pool_maxsize = WORKERS))
+
+def api_get(path, payload):
+  """
+  GET a PagerDuty API path, waiting out rate limits as long as PagerDuty asks
+  to (Retry-After), or backing off exponentially. Returns the parsed JSON.
+  """
+  
+  for attempt in range(MAX_RETRIES + 1):
+    r = session.get(PAGERDUTY_URL + path, params=payload, timeout=TIMEOUT)
+    
+    if r.status_code != 429 or attempt == MAX_RETRIES:
+      break
+    
+    delay = r.headers.get('Retry-After', '')
+    
+    if delay.isdigit():
+      time.sleep(int(delay))
+    else:
+      time.sleep(2 ** attempt)
+  
+  r.raise_for_status()
+  
+  return r.json()
+
+def fetch_pages(key, queries):
+  """
+  GET every page of a paginated PagerDuty listing for each (path, payload) in
+  queries, on up to WORKERS threads. Yields (index, items) per page as it
+  arrives, index being its query's, in no particular order. A query's first
+  page schedules the rest once its total is known. Workers hand pages over
+  through a queue of at most WORKERS, so a crawl is never held in memory
+  whole. Re-raises the first exception raised fetching a page.
+  """
+  
+  if not queries:
+    return
+  
+  tasks = Queue.Queue()
+  pages = Queue.Queue(WORKERS)
+  errors = []
+  
+  for index in range(len(queries)):
+    tasks.put((index, 0))
+  
+  def work():
+    while not errors:
+      task = tasks.get()
+      
+      if task is None:
+        return
+      
+      index, offset = task
+      path, payload = queries[index]
+      
+      try:
+        page = api_get(path, dict(payload, offset = offset, limit = PAGE_SIZE))
+      except:
+        errors.append(sys.exc_info())
+        page = None
+      
+      pages.put((task, page))
+  
+  for i in range(WORKERS):
+    thread = threading.Thread(target=work)
+    thread.setDaemon(True)
+    thread.start()
+  
+  pending = len(queries)
+  
+  while pending and not errors:
+    (index, offset), page = pages.get()
+    pending -= 1
+    
+    if page is None:
+      break
+    
+    if offset == 0:
+      for offset in range(PAGE_SIZE, page.get('total', 0), PAGE_SIZE):
+        tasks.put((index, offset))
+        pending += 1
+    
+    yield index, page[key]
+  
+  # Workers still waiting for a task exit on one of these.
+  for i in range(WORKERS):
+    tasks.put(None)
+  
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+
+def committed(pages):
+  """
+  Pass pages through as they're written to the store, committing it after
+  every STORE_BATCH of them, so a long crawl isn't one transaction.
+  """
+  
+  count = 0
+  
+  for page in pages:
+    yield page
+    count += 1
+    
+    if count % STORE_BATCH == 0:
+      store.commit()
+
+def incidents_query(job):
+  service, start = job
+  payload = {
+    'since': start,
+    'until': until,
+    'service': service,
+    'sort_by': 'created_on:asc',
+    'fields': 'id,incident_key,incident_number,service,status,created_on'
+  }
+  
+  return '/api/v1/incidents', payload
+
+def log_entries_query(job):
+  # The overview holds only trigger, assign, acknowledge and resolve entries.
+  incident_id, start = job
+  payload = {
+    'since': start,
+    'until': until,
+    'is_overview': 'true'
+  }
+  
+  return '/api/v1/incidents/' + incident_id + '/log_entries', payload
+
+def account_log_entries_query(start):
+  # Every incident's overview entries account-wide, each with its incident ID.
+  payload = {
+    'since': start,
+    'until': until,
+    'is_overview': 'true',
+    'include[]': 'incident'
+  }
+  
+  return '/api/v1/log_entries', payload
+
+def api_time(timestamp):
+  # Window bounds are minutes; PagerDuty times are seconds, in UTC.
+  return timestamp + ':00Z'
+
+def store_incident(service, incident):
+  store.execute('INSERT OR REPLACE INTO incidents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (incident['id'], service, incident['service']['name'],
+                 incident['incident_number'], incident['incident_key'],
+                 incident.get('status'), incident.get('created_on')))
+
+def store_log_entries(incident_id, entries):
+  for entry in entries:
+    agent = entry.get('agent') or {}
+    assigned_user = entry.get('assigned_user') or {}
+    entry_id = entry.get('id') or \
+               '%s/%s/%s' % (incident_id, entry['created_at'], entry['type'])
+    
+    store.execute('INSERT OR REPLACE INTO log_entries '
+                  'VALUES (?, ?, ?, ?, ?, ?)',
+                  (entry_id, incident_id, entry['type'], entry['created_at'],
+                   agent.get('name'), assigned_user.get('name')))
+    
+    if entry['type'] == 'resolve':
+      store.execute("UPDATE incidents SET status = 'resolved' WHERE id = ?",
+                    (incident_id,))
+
+def format_line(row):
+  """
+  Format a stored log entry, joined with its incident, as a log line in the
+  human-readable or parsable format.
+  """
+  
+  entry_type, created_at, agent, assigned_user, service_name, \
+    incident_number, incident_key = row
+  
+  # Subtract time zone difference from UTC datetime returned by PagerDuty.
+  entry_date = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%SZ") - timedifference
+  
+  # Determine alert status severity and assign team member.
+  if entry_type in ('acknowledge'):
+    status = 'OK'
+    team_member = agent
+  else:
+    status = 'CRITICAL'
+    team_member = assigned_user
+  
+  # Combine issue ID and description, pulled from email subject, for later use.
+  description = entry_type.upper() + ": " + str(incident_number) + " (" + incident_key + ")"
+  
+  # Consolidate information into separate log lines.
+  if options.flag_human == True:
+    # Populate values list with data pulled from PagerDuty.
+    values = [
+      # Format datetime string in accordance with opsview_reporter script output convention.
+      entry_date.strftime("%Y/%m/%d %H:%M"),
+      service_name,             # PagerDuty service.
+      team_member,              # Name of on-call team member.
+      status,                 # OK if resolve or acknowledge, otherwise CRITICAL.
+      description               # Description of issue, parsed.
+    ]
+    
+    # Tab separated values.
+    return '\t '.join(map(str,values))
+  else:
+    # Populate values list with data pulled from PagerDuty.
+    values = [
+      # Format datetime string in accordance with Nagios log convention.
+      '[' + entry_date.strftime('%s') + '] SERVICE NOTIFICATION: oncall ' + service_name,
+      service_name,             # PagerDuty service.
+      team_member,              # Name of on-call team member.
+      status,                 # OK if resolve or acknowledge, otherwise CRITICAL.
+      description               # Description of issue, parsed.
+    ]
+    
+    # Semicolon separated values.
+    return '; '.join(map(str,values))
+
+def service_log_lines(service):
+  """
+  Stream a service's assign and acknowledge log entries in the since-until
+  window out of the store, oldest first. Yields (created_at, line) tuples,
+  sorted; only entries sharing a timestamp are held to be ordered.
+  """
+  
+  window = (api_time(since), api_time(until))
+  group = []
+  
+  for row in store.execute('SELECT l.type, l.created_at, l.agent, '
+                           'l.assigned_user, i.service_name, '
+                           'i.incident_number, i.incident_key '
+                           'FROM log_entries l JOIN incidents i '
+                           'ON l.incident = i.id WHERE i.service = ? AND '
+                           'i.created_on BETWEEN ? AND ? AND '
+                           'l.created_at BETWEEN ? AND ? AND '
+                           "l.type IN ('assign', 'acknowledge') "
+                           'ORDER BY l.created_at',
+                           (service,) + window + window):
+    if group and group[0][0] != row[1]:
+      group.sort()
+      
+      for item in group:
+        yield item
+      
+      group = []
+    
+    group.append((row[1], format_line(row)))
+  
+  group.sort()
+  
+  for item in group:
+    yield item
+
+def merge(streams):
+  """
+  Merge iterables that are each sorted into one sorted stream, holding only the
+  head of each in memory. Stands in for heapq.merge, new in Python 2.6.
+  """
+  
+  heap = []
+  
+  for index, stream in enumerate(streams):
+    stream = iter(stream)
+    
+    for value in stream:
+      heap.append((value, index, stream))
+      break
+  
+  heapq.heapify(heap)
+  
+  while heap:
+    value, index, stream = heap[0]
+    yield value
+    
+    try:
+      heapq.heapreplace(heap, (stream.next(), index, stream))
+    except StopIteration:
+      heapq.heappop(heap)
+
+def write_lines(output, lines):
+  """
+  Write a batch of log lines to output in one call, and a progress dot per line
+  to stdout when writing the parsable log file.
+  """
+  
+  if not lines:
+    return
+  
+  output.write('\n'.join(lines) + '\n')
+  
+  if options.flag_human != True:
+    sys.stdout.write('. ' * len(lines))
 
 # Parse input arguments and flags.
 parser = optparse.OptionParser()
@@ -39,6 +386,11 @@ parser.add_option("-D", "--reporter-script-date",
 parser.add_option("-H", "--human-readable",
                   action = "store_true", dest = "flag_human", default = False,
                   help = "Print log messages in a readable format to stdout.")
+parser.add_option("-b", "--batch",
+                  action = "store_true", dest = "flag_batch", default = False,
+                  help = "Query incidents for all services at once, and log "
+                  "entries account-wide rather than per incident. Far fewer "
+                  "requests for many services.")
 
 (options, args) = parser.parse_args()
 
@@ -80,99 +432,108 @@ else:
 # Script will always crawl for incident logs from 'since' date to current date.
 until = datetime.strftime(datetime.now() + timedifference, "%Y-%m-%dT%H:%M")
 
-# Fetch incident list from PagerDuty API.
+store = sqlite3.connect(STORE_PATH)
+store.executescript(SCHEMA)
+
+# Resume each service from its checkpoint when the stored window overlaps the
+# start of this one. Still-open incidents it holds may have gained log entries
+# since, so theirs are fetched again from the checkpoint on.
+incident_jobs = []
+entry_jobs = []
+checkpoints = {}
+
 for service in SERVICES:
-  url = PAGERDUTY_URL + '/api/v1/incidents'
-  headers = { 'Authorization': 'Token token=' + API_TOKEN }
-  payload = {
-    'since': since,
-    'until': until,
-    'service': service,
-    'fields': 'id,incident_key,incident_number,service'
-  }
+  start = since
+  checkpoint = store.execute('SELECT since, until FROM checkpoints '
+                             'WHERE service = ?', (service,)).fetchone()
   
-  r = requests.get(url, headers=headers, params=payload)
+  if checkpoint and checkpoint[0] <= since <= checkpoint[1]:
+    start = max(since, checkpoint[1])
+    
+    for row in store.execute("SELECT id FROM incidents WHERE service = ? AND "
+                             "status != 'resolved' AND "
+                             "created_on BETWEEN ? AND ?",
+                             (service, api_time(since), api_time(until))):
+      entry_jobs.append((row[0], start))
   
-  # Trim the fat.
-  incidents_dict = r.json()
-  incidents = incidents_dict['incidents']
+  if checkpoint and since <= checkpoint[1]:
+    checkpoints[service] = (min(since, checkpoint[0]),
+                            max(until, checkpoint[1]))
+  else:
+    checkpoints[service] = (since, until)
   
-  # Create blank log lines list for later use.
-  log_lines = []
+  if start < until:
+    incident_jobs.append((service, start))
+
+# Fetch every page of new incidents from PagerDuty API for every service, then
+# of log entries for every incident, concurrently, and store each page as it
+# arrives.
+if options.flag_batch == True:
+  # One incident listing for all services resuming from the same start.
+  starts = {}
   
-  # Iterate through incidents, pull, parse and store pertinent log entries.
-  for incident in incidents:
-    url = PAGERDUTY_URL + '/api/v1/incidents/' + incident['id'] + '/log_entries'
-    headers = { 'Authorization': 'Token token=' + API_TOKEN }
-    payload = {
-      'since': since,
-      'until': until
-    }
-    
-    r = requests.get(url, headers=headers, params=payload)
+  for service, start in incident_jobs:
+    starts.setdefault(start, []).append(service)
   
-    # Trim the fat.
-    entries_dict = r.json()
-    entries = entries_dict['log_entries']
-    
-    for entry in entries:
-      # Ensure we parse only log entries we care about.
-      if not entry['type'] in ('assign', 'acknowledge'):
-        continue
-      
-      # Subtract time zone difference from UTC datetime returned by PagerDuty.
-      entry_date = datetime.strptime(entry['created_at'], "%Y-%m-%dT%H:%M:%SZ") - timedifference
-      
-      # Determine alert status severity and assign team member.
-      if entry['type'] in ('acknowledge'):
-        status = 'OK'
-        team_member = entry['agent']['name']
-      else:
-        status = 'CRITICAL'
-        team_member = entry['assigned_user']['name']
-      
-      # Combine issue ID and description, pulled from email subject, for later use.
-      description = entry['type'].upper() + ": " + str(incident['incident_number']) + " (" + incident['incident_key'] + ")"
-      
-      # Consolidate information into separate log lines.
-      if options.flag_human == True:
-        # Populate values list with data pulled from PagerDuty.
-        values = [
-          # Format datetime string in accordance with opsview_reporter script output convention.
-          entry_date.strftime("%Y/%m/%d %H:%M"),
-          incident['service']['name'],      # PagerDuty service.
-          team_member,              # Name of on-call team member.
-          status,                 # OK if resolve or acknowledge, otherwise CRITICAL.
-          description               # Description of issue, parsed.
-        ]
-        
-        # Append each log line with tab separated values.
-        log_lines.append('\t '.join(map(str,values)))
-      else:
-        # Populate values list with data pulled from PagerDuty.
-        values = [
-          # Format datetime string in accordance with Nagios log convention.
-          '[' + entry_date.strftime('%s') + '] SERVICE NOTIFICATION: oncall ' + incident['service']['name'],
-          incident['service']['name'],      # PagerDuty service.
-          team_member,              # Name of on-call team member.
-          status,                 # OK if resolve or acknowledge, otherwise CRITICAL.
-          description               # Description of issue, parsed.
-        ]
+  starts = sorted(starts.items())
+  
+  for index, incidents in committed(fetch_pages('incidents', [
+      incidents_query((','.join(services), start))
+      for start, services in starts])):
+    for incident in incidents:
+      store_incident(incident['service']['id'], incident)
+      entry_jobs.append((incident['id'], starts[index][0]))
+  
+  # One account-wide log entry listing from the earliest start, keeping only
+  # entries of the incidents wanted, from each one's own start.
+  starts = dict([(incident_id, api_time(start))
+                 for incident_id, start in entry_jobs])
+  
+  if entry_jobs:
+    for index, entries in committed(fetch_pages('log_entries', [
+        account_log_entries_query(min([start for incident_id, start
+                                       in entry_jobs]))])):
+      for entry in entries:
+        incident_id = entry['incident']['id']
         
-        # Append each log line with semicolon separated values.
-        log_lines.append('; '.join(map(str,values)))
+        if incident_id in starts and starts[incident_id] <= entry['created_at']:
+          store_log_entries(incident_id, [entry])
+else:
+  for index, incidents in committed(fetch_pages('incidents',
+                                                map(incidents_query,
+                                                    incident_jobs))):
+    for incident in incidents:
+      store_incident(incident_jobs[index][0], incident)
+      entry_jobs.append((incident['id'], incident_jobs[index][1]))
+  
+  for index, entries in committed(fetch_pages('log_entries',
+                                              map(log_entries_query,
+                                                  entry_jobs))):
+    store_log_entries(entry_jobs[index][0], entries)
 
-  # Output complete list of log lines.
-  if options.flag_human == True:
-    # Print all log lines.
-    for line in sorted(log_lines):
-      print line
-  else:
-    # Store log lines to parsable file.
-    for line in sorted(log_lines):
-      logfile.write(line)
-      logfile.write("\n")
-      print '.',
+for service in SERVICES:
+  store.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                (service,) + checkpoints[service])
+
+store.commit()
+
+# Merge every service's log lines into one time ordered stream, and write it
+# out in batches as it's read from the store.
+if options.flag_human == True:
+  output = sys.stdout
+else:
+  output = logfile
+
+batch = []
+
+for created_at, line in merge(map(service_log_lines, SERVICES)):
+  batch.append(line)
+  
+  if len(batch) == OUTPUT_BATCH:
+    write_lines(output, batch)
+    batch = []
+
+write_lines(output, batch)
 
 if options.flag_human != True:
   logfile.close()
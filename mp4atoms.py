@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#
+# mp4atoms.py - Minimal QuickTime/MP4 atom reader. Pulls the same duration,
+#   bitrate and encoder values app.py needs out of the moov atom, without
+#   initializing an ffmpeg demuxer.
+
+import struct
+
+# Atoms that may legitimately appear at the top level of a QuickTime/MP4 file.
+TOP_LEVEL = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pnot', 'uuid',
+             'meta')
+
+class UnsupportedFormat(Exception):
+  """
+  Raised when a file isn't a QuickTime/MP4 container this reader understands.
+  """
+
+def unpack(format, view, offset, end):
+  """
+  struct.unpack_from, refusing to read past end, e.g. the end of the atom being
+  parsed, so corrupt sizes and counts fail as UnsupportedFormat. Returns a
+  tuple.
+  """
+  
+  if offset < 0 or offset + struct.calcsize(format) > end:
+    raise UnsupportedFormat('Truncated atom.')
+  
+  return struct.unpack_from(format, view, offset)
+
+def iter_atoms(view, start, end):
+  """
+  Walk sibling atoms within view[start:end]. Yields (type, body start, body
+  end) tuples, with offsets relative to view.
+  """
+  
+  while start + 8 <= end:
+    size, kind = struct.unpack_from('>I4s', view, start)
+    header = 8
+    
+    if size == 1:
+      size = unpack('>Q', view, start + 8, end)[0]
+      header = 16
+    elif size == 0:
+      size = end - start
+    
+    if size < header or start + size > end:
+      raise UnsupportedFormat('Truncated "%s" atom.' % kind)
+    
+    yield kind, start + header, start + size
+    start += size
+
+def find_atom(view, start, end, path):
+  """
+  Descend through nested atoms by type, e.g. ('mdia', 'minf', 'stbl'). Returns
+  the (body start, body end) of the last atom in path, or None.
+  """
+  
+  for kind, body_start, body_end in iter_atoms(view, start, end):
+    if kind == path[0]:
+      if len(path) == 1:
+        return body_start, body_end
+      
+      return find_atom(view, body_start, body_end, path[1:])
+  
+  return None
+
+def read_moov(fileobj):
+  """
+  Skip from atom header to atom header through a seekable file, and read only
+  the moov atom. Returns its bytes, header included.
+  """
+  
+  offset = 0
+  
+  while True:
+    fileobj.seek(offset)
+    header = fileobj.read(16)
+    
+    if len(header) < 8:
+      raise UnsupportedFormat('No moov atom found.')
+    
+    size, kind = struct.unpack_from('>I4s', header)
+    
+    if kind not in TOP_LEVEL:
+      raise UnsupportedFormat('Unexpected top level atom "%s".' % kind)
+    
+    if size == 1:
+      size = unpack('>Q', header, 8, len(header))[0]
+      
+      if size < 16:
+        raise UnsupportedFormat('Truncated "%s" atom.' % kind)
+    elif size == 0:
+      size = None
+    elif size < 8:
+      raise UnsupportedFormat('Truncated "%s" atom.' % kind)
+    
+    if kind == 'moov':
+      fileobj.seek(offset)
+      return fileobj.read(size) if size else fileobj.read()
+    
+    if not size:
+      raise UnsupportedFormat('No moov atom found.')
+    
+    offset += size
+
+def parse_track(view, start, end):
+  """
+  Parse a trak atom body. Returns a dictionary of handler type, media timescale
+  and duration, total sample bytes and sample description.
+  """
+  
+  track = {}
+  
+  tkhd = find_atom(view, start, end, ('tkhd',))
+  mdhd = find_atom(view, start, end, ('mdia', 'mdhd'))
+  hdlr = find_atom(view, start, end, ('mdia', 'hdlr'))
+  stbl = find_atom(view, start, end, ('mdia', 'minf', 'stbl'))
+  
+  if None in (tkhd, mdhd, hdlr, stbl):
+    raise UnsupportedFormat('Incomplete track header.')
+  
+  track['handler'] = unpack('>4s', view, hdlr[0] + 8, hdlr[1])[0]
+  
+  # Media header: 32-bit times in version 0, 64-bit in version 1.
+  if unpack('>B', view, mdhd[0], mdhd[1])[0] == 1:
+    track['timescale'], track['duration'] = \
+      unpack('>IQ', view, mdhd[0] + 20, mdhd[1])
+  else:
+    track['timescale'], track['duration'] = \
+      unpack('>II', view, mdhd[0] + 12, mdhd[1])
+  
+  # Track header width and height are 16.16 fixed point, at the end of the atom.
+  width, height = unpack('>II', view, max(tkhd[1] - 8, tkhd[0]), tkhd[1])
+  track['width'], track['height'] = width >> 16, height >> 16
+  
+  # Sample description: the first entry's format and, for video, the Pascal
+  # string compressor name FFmpeg reports as the encoder.
+  stsd = find_atom(view, stbl[0], stbl[1], ('stsd',))
+  
+  if stsd is None or stsd[1] - stsd[0] < 16:
+    raise UnsupportedFormat('Missing sample description.')
+  
+  entry = stsd[0] + 8
+  track['format'] = view[entry + 4:entry + 8].tobytes()
+  track['encoder'] = None
+  
+  if track['handler'] == 'vide' and entry + 82 <= stsd[1]:
+    length = ord(view[entry + 50:entry + 51].tobytes())
+    name = view[entry + 51:entry + 51 + min(length, 31)].tobytes()
+    track['encoder'] = name.rstrip('\x00') or None
+  
+  # Sample sizes: one constant size, or a table to total up.
+  stsz = find_atom(view, stbl[0], stbl[1], ('stsz',))
+  
+  if stsz is None:
+    raise UnsupportedFormat('Missing sample size table.')
+  
+  sample_size, count = unpack('>II', view, stsz[0] + 4, stsz[1])
+  
+  if sample_size:
+    track['data_size'] = sample_size * count
+  elif stsz[0] + 12 + count * 4 > stsz[1]:
+    # Checked up front, as a corrupt count could ask for gigabytes.
+    raise UnsupportedFormat('Truncated sample size table.')
+  else:
+    track['data_size'] = sum(struct.unpack_from('>%dI' % count, view,
+                                                stsz[0] + 12))
+  
+  return track
+
+def probe(fileobj):
+  """
+  Read video metadata from a seekable QuickTime/MP4 file. Returns a dictionary
+  of encoder, duration in seconds and bit rate in bits per second, matching
+  what FFmpeg's mov demuxer reports for the first video track.
+  """
+  
+  moov = read_moov(fileobj)
+  view = memoryview(moov)
+  body = find_atom(view, 0, len(moov), ('moov',))
+  
+  if body is None:
+    raise UnsupportedFormat('No moov atom found.')
+  
+  moov_start, moov_end = body
+  
+  for kind, start, end in iter_atoms(view, moov_start, moov_end):
+    if kind != 'trak':
+      continue
+    
+    track = parse_track(view, start, end)
+    
+    if track['handler'] != 'vide':
+      continue
+    
+    if not track['encoder'] or not track['timescale'] or not track['duration']:
+      raise UnsupportedFormat('Video track lacks encoder or duration.')
+    
+    return {
+      'encoder': track['encoder'],
+      'duration': float(track['duration']) / track['timescale'],
+      'bit_rate': track['data_size'] * 8 * track['timescale']
+                  / track['duration'],
+      'width': track['width'],
+      'height': track['height']
+    }
+  
+  raise UnsupportedFormat('No video track found.')